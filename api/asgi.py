@@ -0,0 +1,249 @@
+# asgi.py: 非同步 (ASGI) 服務入口
+#
+# WSGI (gunicorn) 模式下，每個請求在等待遠端價格與預處理數據時會佔住一整個 worker 執行緒。
+# ASGI 模式重用同一個 Flask 應用 (所有藍圖與處理邏輯不變)，但在交給 Flask 之前，
+# 先依請求內容以非阻塞 I/O 並行下載所需的數據並寫入 data_handler 的快取：
+# 等待數據的請求只是事件迴圈中的協程，不佔用執行緒；數據到齊後，Flask 處理函式
+# (對齊、模擬等 CPU 工作) 在執行緒池中執行，直接命中快取。
+#
+# 啟動方式 (需要 uvicorn 與 httpx；未安裝 httpx 時不預先下載，數據改由 Flask 以阻塞方式讀取)：
+#   uvicorn api.asgi:app --host 0.0.0.0 --port 10000 --workers 4
+
+import asyncio
+import io
+import json
+import os
+import sys
+from concurrent.futures import ThreadPoolExecutor
+
+from .index import app as flask_app
+from .utils.data_handler import data_url, parse_ticker_csv, load_ticker_history, get_preprocessed_data, get_data_version, get_metric_state
+
+try:
+    import httpx  # 選用套件，未安裝時不進行非同步預先下載
+except ImportError:
+    httpx = None
+
+# --- ASGI 服務設定 ---
+# ASGI_THREADS          : 執行 Flask 處理函式 (CPU 工作) 的執行緒數
+# ASGI_FETCH_CONCURRENCY: 每個 worker 同時進行的遠端讀取上限，避免瞬間大量連線打到數據來源
+# ASGI_FETCH_TIMEOUT    : 單次遠端讀取的逾時秒數
+ASGI_THREADS = int(os.environ.get('ASGI_THREADS', 8))
+ASGI_FETCH_CONCURRENCY = int(os.environ.get('ASGI_FETCH_CONCURRENCY', 32))
+ASGI_FETCH_TIMEOUT = float(os.environ.get('ASGI_FETCH_TIMEOUT', 30))
+# 請求本文上限 (位元組)，超過時直接回傳 413
+MAX_BODY_BYTES = int(os.environ.get('ASGI_MAX_BODY_BYTES', 1024 * 1024))
+
+# 需要預處理數據 / 數據版本 (ETag) 的端點
+PREPROCESSED_PATHS = {'/api/scan', '/api/screener', '/api/all-tickers'}
+VERSIONED_PATHS = {'/api/backtest', '/api/walk-forward', '/api/scan', '/api/screener', '/api/all-tickers', '/api/ticker-stats'}
+
+
+def prefetch_plan(path, body):
+    """
+    依請求路徑與 JSON 本文決定要預先下載的數據，回傳 (股票代碼列表, 其他數據名稱集合)。
+    本文無法解析時只回傳不需本文的項目，錯誤交由 Flask 處理函式回報。
+    """
+    try:
+        data = json.loads(body) if body else {}
+    except ValueError:
+        data = {}
+    if not isinstance(data, dict):
+        data = {}
+
+    tickers = []
+    try:
+        if path in ('/api/backtest', '/api/monte-carlo', '/api/walk-forward'):
+            tickers = [ticker for p in data.get('portfolios', []) for ticker in p.get('tickers', [])]
+        elif path == '/api/scan':
+            tickers = list(data.get('tickers', []))
+    except (AttributeError, TypeError):
+        tickers = []
+    if tickers and data.get('benchmark'):
+        tickers.append(data['benchmark'])
+
+    resources = set()
+    if path in PREPROCESSED_PATHS:
+        resources.add('preprocessed')
+    if path in VERSIONED_PATHS:
+        resources.add('version')
+    if path == '/api/ticker-stats':
+        resources.add('metric_state')
+    return [ticker for ticker in dict.fromkeys(tickers) if isinstance(ticker, str) and ticker], resources
+
+
+class DataPrefetcher:
+    """
+    以 httpx.AsyncClient 並行下載數據並寫入 data_handler 的快取。
+    同一個項目同時只會下載一次 (協程層級的 single-flight)；下載失敗時不寫入快取，
+    之後由 Flask 處理函式以原本的阻塞讀取重試並回報錯誤 (失敗結果也依原本的規則短暫快取)。
+    """
+
+    def __init__(self, executor):
+        self.executor = executor
+        self.client = None
+        self._semaphore = None
+        self._inflight = {}
+
+    async def start(self):
+        if httpx is None:
+            print("警告：未安裝 httpx，ASGI 模式不會預先以非阻塞方式下載數據")
+            return
+        self.client = httpx.AsyncClient(timeout=ASGI_FETCH_TIMEOUT, limits=httpx.Limits(max_connections=ASGI_FETCH_CONCURRENCY))
+        self._semaphore = asyncio.Semaphore(ASGI_FETCH_CONCURRENCY)
+
+    async def close(self):
+        if self.client is not None:
+            await self.client.aclose()
+            self.client = None
+
+    async def prefetch(self, tickers, resources):
+        if self.client is None:
+            return
+        jobs = [self._once(('ticker', ticker), self._fetch_ticker, ticker)
+                for ticker in tickers if not load_ticker_history.cache_contains(ticker)]
+        if 'preprocessed' in resources and not get_preprocessed_data.cache_contains():
+            jobs.append(self._once('preprocessed', self._fetch_json, 'preprocessed_data.json', get_preprocessed_data))
+        if 'version' in resources and not get_data_version.cache_contains():
+            jobs.append(self._once('version', self._fetch_version))
+        if 'metric_state' in resources and not get_metric_state.cache_contains():
+            jobs.append(self._once('metric_state', self._fetch_json, 'metric_state.json', get_metric_state))
+        if jobs:
+            await asyncio.gather(*jobs)
+
+    async def _once(self, key, fetch, *args):
+        task = self._inflight.get(key)
+        if task is None:
+            task = self._inflight[key] = asyncio.ensure_future(fetch(*args))
+            task.add_done_callback(lambda _: self._inflight.pop(key, None))
+        try:
+            # shield：某個請求被取消 (用戶端斷線) 時，不影響其他等待同一項目的請求
+            await asyncio.shield(task)
+        except Exception as e:
+            print(f"警告：非同步預先下載 {key} 失敗，改由處理函式讀取: {e}")
+
+    async def _get(self, path):
+        async with self._semaphore:
+            response = await self.client.get(data_url(path))
+            response.raise_for_status()
+            return response.content
+
+    async def _fetch_ticker(self, ticker):
+        content = await self._get(f"prices/{ticker}.csv")
+        # CSV 解析是 CPU 工作，移到執行緒池以免阻塞事件迴圈
+        history = await asyncio.get_running_loop().run_in_executor(self.executor, parse_ticker_csv, ticker, io.BytesIO(content))
+        load_ticker_history.cache_set(history, ticker)
+
+    async def _fetch_json(self, path, cached_function):
+        content = await self._get(path)
+        value = await asyncio.get_running_loop().run_in_executor(self.executor, json.loads, content)
+        cached_function.cache_set(value)
+
+    async def _fetch_version(self):
+        content = await self._get("version.json")
+        get_data_version.cache_set(str(json.loads(content)['version']))
+
+
+def _wsgi_environ(scope, body):
+    """由 ASGI scope 與請求本文建立 WSGI environ (PEP 3333)。"""
+    server = scope.get('server') or ('localhost', 80)
+    environ = {
+        'REQUEST_METHOD': scope['method'],
+        'SCRIPT_NAME': scope.get('root_path', '').encode('utf-8').decode('latin-1'),
+        'PATH_INFO': scope['path'].encode('utf-8').decode('latin-1'),
+        'QUERY_STRING': scope.get('query_string', b'').decode('latin-1'),
+        'SERVER_NAME': server[0],
+        'SERVER_PORT': str(server[1]),
+        'SERVER_PROTOCOL': f"HTTP/{scope.get('http_version', '1.1')}",
+        'CONTENT_LENGTH': str(len(body)),
+        'wsgi.version': (1, 0),
+        'wsgi.url_scheme': scope.get('scheme', 'http'),
+        'wsgi.input': io.BytesIO(body),
+        'wsgi.errors': sys.stderr,
+        'wsgi.multithread': True,
+        'wsgi.multiprocess': True,
+        'wsgi.run_once': False,
+    }
+    if scope.get('client'):
+        environ['REMOTE_ADDR'] = scope['client'][0]
+    for raw_name, raw_value in scope.get('headers', []):
+        name, value = raw_name.decode('latin-1'), raw_value.decode('latin-1')
+        if name == 'content-length':
+            continue
+        key = 'CONTENT_TYPE' if name == 'content-type' else 'HTTP_' + name.upper().replace('-', '_')
+        environ[key] = f"{environ[key]},{value}" if key in environ else value
+    return environ
+
+
+def _call_flask(environ):
+    """在執行緒池中執行 Flask 應用，回傳 (狀態碼, 標頭, 本文)。"""
+    started = {}
+
+    def start_response(status, headers, exc_info=None):
+        started['status'], started['headers'] = status, headers
+
+    result = flask_app(environ, start_response)
+    try:
+        body = b''.join(result)
+    finally:
+        if hasattr(result, 'close'):
+            result.close()
+    headers = [(name.lower().encode('latin-1'), value.encode('latin-1')) for name, value in started['headers']]
+    return int(started['status'].split(' ', 1)[0]), headers, body
+
+
+class AsyncApp:
+    """ASGI 應用：非同步預先下載數據後，將請求交給執行緒池中的 Flask 應用處理。"""
+
+    def __init__(self):
+        self.executor = ThreadPoolExecutor(max_workers=ASGI_THREADS, thread_name_prefix='flask')
+        self.prefetcher = DataPrefetcher(self.executor)
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] == 'lifespan':
+            await self._lifespan(receive, send)
+        elif scope['type'] == 'http':
+            await self._http(scope, receive, send)
+
+    async def _lifespan(self, receive, send):
+        while True:
+            message = await receive()
+            if message['type'] == 'lifespan.startup':
+                await self.prefetcher.start()
+                await send({'type': 'lifespan.startup.complete'})
+            elif message['type'] == 'lifespan.shutdown':
+                await self.prefetcher.close()
+                self.executor.shutdown(wait=False)
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
+
+    async def _http(self, scope, receive, send):
+        chunks, size = [], 0
+        while True:
+            message = await receive()
+            if message['type'] == 'http.disconnect':
+                return
+            chunk = message.get('body', b'')
+            size += len(chunk)
+            if size > MAX_BODY_BYTES:
+                await self._send(send, 413, [(b'content-type', b'application/json')], json.dumps({'error': '請求內容過大。'}).encode('utf-8'))
+                return
+            chunks.append(chunk)
+            if not message.get('more_body', False):
+                break
+        body = b''.join(chunks)
+
+        tickers, resources = prefetch_plan(scope['path'], body)
+        await self.prefetcher.prefetch(tickers, resources)
+
+        status, headers, response_body = await asyncio.get_running_loop().run_in_executor(
+            self.executor, _call_flask, _wsgi_environ(scope, body))
+        await self._send(send, status, headers, response_body)
+
+    @staticmethod
+    async def _send(send, status, headers, body):
+        await send({'type': 'http.response.start', 'status': status, 'headers': headers})
+        await send({'type': 'http.response.body', 'body': body})
+
+
+app = AsyncApp()
@@ -1,9 +1,20 @@
-from flask import Flask, send_from_directory
+import time
+
+# 記錄模組開始匯入的時間點，用來量測冷啟動的匯入耗時
+_import_start_time = time.perf_counter()
+
+from flask import Flask, send_from_directory, jsonify
 import os
 
 # 從 routes 套件中匯入我們建立的藍圖
 from .routes.backtest_route import backtest_bp
 from .routes.scan_route import scan_bp
+from .routes.metrics_route import metrics_bp
+from .routes.monte_carlo_route import monte_carlo_bp
+from .routes.walk_forward_route import walk_forward_bp
+from .utils.instrumentation import init_instrumentation
+from .utils.http_cache import init_http_cache
+from .utils.startup import STARTUP_MODE, STARTUP_TIMINGS, record_timing, warm_up
 
 # --- 建立靜態檔案的絕對路徑 ---
 # 取得目前檔案 (index.py) 所在的目錄
@@ -24,6 +35,31 @@ app = Flask(__name__, static_folder=public_folder_path, static_url_path='')
 # 註冊藍圖，並為所有路由加上 /api 的前綴
 app.register_blueprint(backtest_bp, url_prefix='/api')
 app.register_blueprint(scan_bp, url_prefix='/api')
+app.register_blueprint(metrics_bp, url_prefix='/api')
+app.register_blueprint(monte_carlo_bp, url_prefix='/api')
+app.register_blueprint(walk_forward_bp, url_prefix='/api')
+
+# 為每個請求記錄各階段耗時，輸出 Server-Timing 標頭與 /api/metrics 統計
+init_instrumentation(app)
+# 壓縮較大的 JSON 回應 (須在 init_instrumentation 之後註冊，壓縮耗時才會計入 Server-Timing)
+init_http_cache(app)
+
+record_timing('import', _import_start_time)
+
+# --- 啟動模式 ---
+# preload 模式 (gunicorn --preload)：在 master 行程中預先匯入並暖機快取，fork 後各 worker 共享
+# serverless 模式：什麼都不做，重型套件與遠端數據延遲到第一次請求時才載入
+if STARTUP_MODE == 'preload':
+    _warm_up_start_time = time.perf_counter()
+    warm_up()
+    record_timing('warm_up', _warm_up_start_time)
+
+print(f"--- 啟動模式: {STARTUP_MODE}，耗時 (ms): {STARTUP_TIMINGS} ---")
+
+@app.route('/api/health', methods=['GET'])
+def health_handler():
+    """回報啟動模式與各階段耗時，用於追蹤冷啟動的效能退化。"""
+    return jsonify({'status': 'ok', 'startupMode': STARTUP_MODE, 'startupTimings': STARTUP_TIMINGS})
 
 # 新增一個根路由，用來提供前端的主頁面
 @app.route('/', methods=['GET'])
@@ -1,76 +1,121 @@
 # backtest_route.py: 專門處理與投資組合回測相關的 API 路由
 
 from flask import Blueprint, request, jsonify
-import pandas as pd
-from pandas.tseries.offsets import MonthEnd
 import traceback
 
 # 使用相對路徑從上層的 utils 模組匯入核心邏輯
-from ..utils.data_handler import read_price_data_from_repo, validate_data_completeness
-from ..utils.simulation import run_simulation
-from ..utils.calculations import calculate_metrics
+from ..utils.data_handler import align_prices, find_late_starts
+from ..utils.request_params import PortfolioRequest, RequestError
+from ..utils.simulation import run_simulation, simulate_portfolios
+from ..utils.parallel import run_partitioned, PARALLEL_MIN_PORTFOLIOS
+from ..utils.calculations import calculate_metrics, prepare_benchmark
+from ..utils.startup import lazy_module
+from ..utils.instrumentation import span, json_response
+from ..utils.http_cache import conditional
+
+pd = lazy_module('pandas')
 
 # 建立一個名為 'backtest' 的藍圖
 backtest_bp = Blueprint('backtest', __name__)
 
 @backtest_bp.route('/backtest', methods=['POST'])
+@conditional()
 def backtest_handler():
     """處理投資組合回測請求。"""
     try:
         data = request.get_json()
-        start_date_str = f"{data['startYear']}-{data['startMonth']}-01"
-        end_date = pd.to_datetime(f"{data['endYear']}-{data['endMonth']}-01") + MonthEnd(0)
-        end_date_str = end_date.strftime('%Y-%m-%d')
-        
-        all_tickers = set(ticker for p in data['portfolios'] for ticker in p['tickers'])
-        benchmark_ticker = data.get('benchmark')
-        if benchmark_ticker:
-            all_tickers.add(benchmark_ticker)
+        params = PortfolioRequest(data)
+        start_date_str, end_date, end_date_str = params.start_date_str, params.end_date, params.end_date_str
+        all_tickers_tuple, benchmark_ticker = params.all_tickers, params.benchmark_ticker
             
-        all_tickers_tuple = tuple(sorted(list(all_tickers)))
-        if not all_tickers_tuple:
-            return jsonify({'error': '請至少在一個投資組合中設定一項資產。'}), 400
-            
-        df_prices_raw = read_price_data_from_repo(all_tickers_tuple, start_date_str, end_date_str)
+        # 先只建立每支股票有效日期的索引，之後再依需要切出價格
+        price_ranges = params.load_price_ranges()
+        requested_start_date = params.start_date
+        in_range_tickers = [ticker for ticker, (first, last) in price_ranges.items() if first <= end_date and last >= requested_start_date]
         
-        if df_prices_raw.empty:
+        if not in_range_tickers:
             return jsonify({'error': f"在指定的時間範圍內找不到任何請求的股票數據。"}), 400
 
-        # ... (其餘邏輯與之前版本相同) ...
-        problematic_tickers_info = validate_data_completeness(df_prices_raw, all_tickers_tuple, pd.to_datetime(start_date_str))
+        # alignment: 'common' (預設) 讓所有投資組合與基準共用同一段共同交易日；
+        # 'portfolio' 讓每個投資組合只依自身資產對齊，避免某個新上市的資產截短其他投資組合
+        per_portfolio = data.get('alignment', 'common') == 'portfolio'
+        problematic_tickers_info = find_late_starts(price_ranges, in_range_tickers, requested_start_date)
         warning_message = None
         if problematic_tickers_info:
             tickers_str = ", ".join([f"{item['ticker']} (從 {item['start_date']} 開始)" for item in problematic_tickers_info])
-            warning_message = f"部分資產的數據起始日晚於您的選擇。回測已自動調整至最早的共同可用日期。週期受影響的資產：{tickers_str}"
+            if per_portfolio:
+                warning_message = f"部分資產的數據起始日晚於您的選擇。含有這些資產的投資組合已各自調整至其共同可用日期。受影響的資產：{tickers_str}"
+            else:
+                warning_message = f"部分資產的數據起始日晚於您的選擇。回測已自動調整至最早的共同可用日期。週期受影響的資產：{tickers_str}"
             
-        df_prices_common = df_prices_raw.dropna()
-        if df_prices_common.empty:
-            return jsonify({'error': '在指定的時間範圍內，找不到所有股票的共同交易日。'}), 400
+        df_prices_common = None
+        if not per_portfolio:
+            with span('alignment'):
+                df_prices_common = align_prices(all_tickers_tuple, start_date_str, end_date_str, price_ranges)
+            if df_prices_common.empty:
+                return jsonify({'error': '在指定的時間範圍內，找不到所有股票的共同交易日。'}), 400
+            # 在分配給子行程之前先一次套用調整因子，只有價格矩陣經過共享記憶體，不必將因子表 pickle 給每個區塊
+            common_factors = params.adjustment_factors(df_prices_common)
+            if common_factors is not None:
+                df_prices_common = df_prices_common * common_factors
             
-        initial_amount = float(data['initialAmount'])
+        initial_amount = params.initial_amount
         benchmark_result = None
         benchmark_history = None
         
-        if benchmark_ticker and benchmark_ticker in df_prices_common.columns:
-            benchmark_config = {'name': benchmark_ticker, 'tickers': [benchmark_ticker], 'weights': [100], 'rebalancingPeriod': 'never'}
-            benchmark_result = run_simulation(benchmark_config, df_prices_common, initial_amount)
+        if benchmark_ticker and benchmark_ticker in price_ranges:
+            if per_portfolio:
+                with span('alignment'):
+                    benchmark_prices = align_prices([benchmark_ticker], start_date_str, end_date_str, price_ranges)
+            else:
+                benchmark_prices = df_prices_common
+            if not benchmark_prices.empty:
+                benchmark_config = {'name': benchmark_ticker, 'tickers': [benchmark_ticker], 'weights': [100], 'rebalancingPeriod': 'never'}
+                # 共同對齊模式的價格已套用調整因子
+                benchmark_factors = params.adjustment_factors(benchmark_prices) if per_portfolio else None
+                benchmark_result = run_simulation(benchmark_config, benchmark_prices, initial_amount, adjustment_factors=benchmark_factors)
             if benchmark_result:
                 benchmark_history = pd.DataFrame(benchmark_result['portfolioHistory']).set_index('date')
                 benchmark_history.index = pd.to_datetime(benchmark_history.index)
                 
-        results = [res for p_config in data['portfolios'] if p_config['tickers'] and (res := run_simulation(p_config, df_prices_common, initial_amount, benchmark_history))]
+        portfolio_configs = params.portfolio_configs
+        if per_portfolio:
+            results = []
+            for p_config in portfolio_configs:
+                with span('alignment'):
+                    portfolio_prices = align_prices(p_config['tickers'], start_date_str, end_date_str, price_ranges)
+                if portfolio_prices.empty:
+                    continue
+                # 基準截取至與投資組合相同的區間，讓 Beta/Alpha 比較的是同一段期間
+                portfolio_benchmark = None
+                if benchmark_history is not None:
+                    portfolio_benchmark = prepare_benchmark(benchmark_history.loc[portfolio_prices.index[0]:portfolio_prices.index[-1]])
+                if res := run_simulation(p_config, portfolio_prices, initial_amount, portfolio_benchmark, params.adjustment_factors(portfolio_prices)):
+                    results.append(res)
+        else:
+            # 基準的日報酬只計算一次，供每個投資組合計算 Beta/Alpha 時共用
+            benchmark_returns = prepare_benchmark(benchmark_history)
+            # 投資組合數量超過門檻時，會透過共享記憶體分散到多個行程模擬，結果依原順序合併
+            results = [res for res in run_partitioned(simulate_portfolios, df_prices_common, portfolio_configs, initial_amount, benchmark_returns, min_items=PARALLEL_MIN_PORTFOLIOS) if res]
         
         if not results:
             return jsonify({'error': '沒有足夠的共同交易日來進行回測。'}), 400
             
         if benchmark_result and benchmark_history is not None:
-            temp_metrics = calculate_metrics(benchmark_history)
+            with span('metrics'):
+                temp_metrics = calculate_metrics(benchmark_history)
             benchmark_result.update(temp_metrics)
             benchmark_result['beta'] = 1.0
             benchmark_result['alpha'] = 0.00
 
-        return jsonify({'data': results, 'benchmark': benchmark_result, 'warning': warning_message})
+        factor_warning = params.factor_warning()
+        if factor_warning:
+            warning_message = f"{warning_message} {factor_warning}" if warning_message else factor_warning
+
+        return json_response({'data': results, 'benchmark': benchmark_result, 'warning': warning_message})
         
+    except RequestError as e:
+        return jsonify({'error': str(e)}), 400
     except Exception as e:
         print(traceback.format_exc())
         return jsonify({'error': f'伺服器發生未預期的錯誤: {str(e)}'}), 500
@@ -0,0 +1,13 @@
+# metrics_route.py: 提供 Prometheus 格式的效能統計端點
+
+from flask import Blueprint, Response
+
+from ..utils.instrumentation import render_prometheus
+
+# 建立一個名為 'metrics' 的藍圖
+metrics_bp = Blueprint('metrics', __name__)
+
+@metrics_bp.route('/metrics', methods=['GET'])
+def metrics_handler():
+    """輸出目前 worker 行程的延遲直方圖、請求數與快取命中率。"""
+    return Response(render_prometheus(), mimetype='text/plain; version=0.0.4')
@@ -0,0 +1,75 @@
+# monte_carlo_route.py: 專門處理以歷史報酬進行蒙地卡羅模擬的 API 路由
+
+from flask import Blueprint, request, jsonify
+import secrets
+import traceback
+
+from ..utils.data_handler import align_prices
+from ..utils.request_params import PortfolioRequest, RequestError
+from ..utils.monte_carlo import run_monte_carlo, DEFAULT_PERCENTILES
+from ..utils.calculations import TRADING_DAYS_PER_YEAR
+from ..utils.instrumentation import span, json_response
+
+# --- 請求參數上限，避免單一請求佔用過多 CPU 與記憶體 ---
+MAX_PATHS = 20000
+MAX_HORIZON_YEARS = 50
+
+# 建立一個名為 'monte_carlo' 的藍圖
+monte_carlo_bp = Blueprint('monte_carlo', __name__)
+
+@monte_carlo_bp.route('/monte-carlo', methods=['POST'])
+def monte_carlo_handler():
+    """以區塊拔靴法重抽歷史日報酬，模擬投資組合未來的淨值與績效指標分布。"""
+    try:
+        data = request.get_json()
+        params = PortfolioRequest(data)
+
+        n_paths = int(data.get('numPaths', 1000))
+        horizon_years = float(data.get('horizonYears', 10))
+        block_size = int(data.get('blockSize', 21))
+        if not 1 <= n_paths <= MAX_PATHS:
+            return jsonify({'error': f'模擬路徑數必須介於 1 到 {MAX_PATHS} 之間。'}), 400
+        if not 0 < horizon_years <= MAX_HORIZON_YEARS:
+            return jsonify({'error': f'模擬年數必須大於 0 且不超過 {MAX_HORIZON_YEARS} 年。'}), 400
+        # 模擬天數與 run_monte_carlo 相同地四捨五入，至少需要兩個交易日才能計算報酬的統計量
+        if round(horizon_years * TRADING_DAYS_PER_YEAR) < 2:
+            return jsonify({'error': '模擬期間過短，至少需要 2 個交易日。'}), 400
+        if block_size < 1:
+            return jsonify({'error': '區塊長度必須至少為 1 天。'}), 400
+        # 未指定 seed 時隨機產生，並回傳給前端以便重現相同結果
+        seed = data.get('seed')
+        seed = secrets.randbits(63) if seed is None else int(seed)
+        if seed < 0:
+            return jsonify({'error': '隨機種子 (seed) 必須是非負整數。'}), 400
+
+        price_ranges = params.load_price_ranges(require_all=True)
+
+        # 所有資產與基準在同一段共同交易日上重抽，保留資產間的同期相關
+        with span('alignment'):
+            df_prices = align_prices(params.all_tickers, params.start_date_str, params.end_date_str, price_ranges)
+        if len(df_prices) < 2:
+            return jsonify({'error': '在指定的時間範圍內，找不到所有股票的共同交易日。'}), 400
+
+        factors = params.adjustment_factors(df_prices)
+        if factors is not None:
+            df_prices = df_prices * factors
+
+        returns_frame = df_prices.pct_change().iloc[1:]
+        with span('simulation'):
+            results, benchmark_result = run_monte_carlo(
+                returns_frame, params.portfolio_configs, params.initial_amount, n_paths, horizon_years, block_size, seed,
+                benchmark_ticker=params.benchmark_ticker,
+            )
+
+        return json_response({
+            'seed': seed, 'numPaths': n_paths, 'horizonYears': horizon_years, 'blockSize': block_size,
+            'percentiles': list(DEFAULT_PERCENTILES),
+            'history': {'startDate': df_prices.index[0].strftime('%Y-%m-%d'), 'endDate': df_prices.index[-1].strftime('%Y-%m-%d')},
+            'data': results, 'benchmark': benchmark_result, 'warning': params.factor_warning(),
+        })
+
+    except RequestError as e:
+        return jsonify({'error': str(e)}), 400
+    except Exception as e:
+        print(traceback.format_exc())
+        return jsonify({'error': f'伺服器發生未預期的錯誤: {str(e)}'}), 500
@@ -1,18 +1,27 @@
 # scan_route.py: 專門處理與個股掃描、篩選器相關的 API 路由
 
 from flask import Blueprint, request, jsonify
-import pandas as pd
-from pandas.tseries.offsets import MonthEnd
 import traceback
 
 # 使用相對路徑從上層的 utils 模組匯入核心邏輯
-from ..utils.data_handler import read_price_data_from_repo, get_preprocessed_data, validate_data_completeness
-from ..utils.calculations import calculate_metrics
+from ..utils.data_handler import read_price_data_from_repo, get_preprocessed_data, validate_data_completeness, get_metric_state, load_ticker_prices
+from ..utils.accumulators import STANDARD_WINDOWS, advance_ticker_state, window_metrics
+from ..utils.calculations import calculate_column_metrics, prepare_benchmark
+from ..utils.parallel import run_partitioned
+from ..utils.startup import lazy_module
+from ..utils.instrumentation import span, json_response
+from ..utils.http_cache import conditional
+
+pd = lazy_module('pandas')
+
+# /api/ticker-stats?refresh=1 一次最多併入的股票數，避免單一請求讀取整個股票宇宙的價格檔
+MAX_REFRESH_TICKERS = 50
 
 # 建立一個名為 'scan' 的藍圖
 scan_bp = Blueprint('scan', __name__)
 
 @scan_bp.route('/scan', methods=['POST'])
+@conditional()
 def scan_handler():
     """處理個股掃描請求。"""
     try:
@@ -20,7 +29,7 @@ def scan_handler():
         tickers = data['tickers']
         benchmark_ticker = data.get('benchmark')
         start_date_str = f"{data['startYear']}-{data['startMonth']}-01"
-        end_date = pd.to_datetime(f"{data['endYear']}-{data['endMonth']}-01") + MonthEnd(0)
+        end_date = pd.to_datetime(f"{data['endYear']}-{data['endMonth']}-01") + pd.offsets.MonthEnd(0)
         end_date_str = end_date.strftime('%Y-%m-%d')
         
         if not tickers:
@@ -37,45 +46,49 @@ def scan_handler():
         
         benchmark_history = None
         if benchmark_ticker and benchmark_ticker in df_prices_raw.columns:
-            benchmark_prices = df_prices_raw[[benchmark_ticker]].dropna()
+            with span('alignment'):
+                benchmark_prices = df_prices_raw[[benchmark_ticker]].dropna()
             if not benchmark_prices.empty:
-                benchmark_history = benchmark_prices.rename(columns={benchmark_ticker: 'value'})
+                # 基準的日報酬只計算一次，供每支股票計算 Beta/Alpha 時共用
+                benchmark_history = prepare_benchmark(benchmark_prices.rename(columns={benchmark_ticker: 'value'}))
                 
         results = []
+        pending = []  # 需要計算指標的 (結果位置, 股票代碼)
         requested_start_date = pd.to_datetime(start_date_str)
         
+        with span('alignment'):
+            has_data = df_prices_raw.notna().any()
         for ticker in tickers:
-            try:
-                if ticker not in all_known_tickers:
-                    results.append({'ticker': ticker, 'error': '無此代碼'})
-                    continue
+            if ticker not in all_known_tickers:
+                results.append({'ticker': ticker, 'error': '無此代碼'})
+            elif not has_data.get(ticker, False):
+                results.append({'ticker': ticker, 'error': '指定範圍內無數據'})
+            else:
+                pending.append((len(results), ticker))
+                results.append(None)
 
-                if ticker not in df_prices_raw.columns or df_prices_raw[ticker].dropna().empty:
-                    results.append({'ticker': ticker, 'error': '指定範圍內無數據'})
-                    continue
-                
-                stock_prices = df_prices_raw[ticker].dropna()
-                                    
-                note = None
-                problematic_info = validate_data_completeness(df_prices_raw[[ticker]], [ticker], requested_start_date)
-                if problematic_info:
-                    note = f"(從 {problematic_info[0]['start_date']} 開始)"
-                    
-                history_df = stock_prices.to_frame(name='value')
-                metrics = calculate_metrics(history_df, benchmark_history)
-                results.append({'ticker': ticker, **metrics, 'note': note})
-                
-            except Exception as e:
-                print(f"處理 {ticker} 時發生錯誤: {e}")
-                results.append({'ticker': ticker, 'error': '計算錯誤'})
+        pending_tickers = [ticker for _, ticker in pending]
+        late_start_dates = {item['ticker']: item['start_date'] for item in validate_data_completeness(df_prices_raw, pending_tickers, requested_start_date)}
+
+        # 股票數量超過門檻時，會透過共享記憶體分散到多個行程計算，結果依原順序合併
+        with span('metrics'):
+            metrics_list = run_partitioned(calculate_column_metrics, df_prices_raw, pending_tickers, benchmark_history)
+
+        for (position, ticker), metrics in zip(pending, metrics_list):
+            if metrics is None:
+                results[position] = {'ticker': ticker, 'error': '計算錯誤'}
+                continue
+            note = f"(從 {late_start_dates[ticker]} 開始)" if ticker in late_start_dates else None
+            results[position] = {'ticker': ticker, **metrics, 'note': note}
                 
-        return jsonify(results)
+        return json_response(results)
         
     except Exception as e:
         print(traceback.format_exc())
         return jsonify({'error': f'伺服器發生未預期的錯誤: {str(e)}'}), 500
 
 @scan_bp.route('/screener', methods=['POST'])
+@conditional()
 def screener_handler():
     """處理股票篩選請求。"""
     try:
@@ -117,7 +130,7 @@ def screener_handler():
             if match:
                 filtered_stocks.append(stock['ticker'])
 
-        return jsonify(filtered_stocks)
+        return json_response(filtered_stocks)
     except ValueError as e:
         return jsonify({'error': str(e)}), 500
     except Exception as e:
@@ -125,12 +138,68 @@ def screener_handler():
         return jsonify({'error': f'篩選器發生錯誤: {str(e)}'}), 500
 
 @scan_bp.route('/all-tickers', methods=['GET'])
+@conditional(shared=True)
 def get_all_tickers_handler():
     """提供所有可用於篩選和建議的股票代碼列表。"""
     try:
         all_stocks = get_preprocessed_data()
         ticker_list = [stock['ticker'] for stock in all_stocks if 'ticker' in stock]
-        return jsonify(ticker_list)
+        return json_response(ticker_list)
     except Exception as e:
         print(traceback.format_exc())
         return jsonify({'error': f'無法獲取股票列表: {str(e)}'}), 500
+
+@scan_bp.route('/ticker-stats', methods=['GET'])
+@conditional(shared=True)
+def ticker_stats_handler():
+    """
+    由每日增量更新的累加值直接提供股票在標準區間 (截至最新數據) 的績效指標，不需讀取價格。
+    refresh=1 時會將價格檔中比狀態更新的 K 棒併入 (只計算新增的部分)，須以 tickers 指定股票；
+    併入的結果只用於本次回應，不寫回共用的快取狀態。
+    """
+    try:
+        window = request.args.get('window', 'max')
+        if window not in STANDARD_WINDOWS:
+            return jsonify({'error': f"不支援的指標區間: {window}，可用區間: {', '.join(STANDARD_WINDOWS)}"}), 400
+        refresh = request.args.get('refresh', '').lower() in ('1', 'true')
+
+        metric_state = get_metric_state()
+        if not metric_state:
+            return jsonify({'error': '無法讀取指標狀態。'}), 500
+        states = metric_state['tickers']
+        tickers_param = request.args.get('tickers')
+        tickers = [ticker for ticker in tickers_param.split(',') if ticker] if tickers_param else sorted(states)
+        if refresh and not tickers_param:
+            return jsonify({'error': 'refresh=1 時必須以 tickers 指定股票。'}), 400
+        if refresh and len(tickers) > MAX_REFRESH_TICKERS:
+            return jsonify({'error': f'refresh=1 時最多只能指定 {MAX_REFRESH_TICKERS} 支股票。'}), 400
+
+        warning_message = None
+        benchmark_returns = None
+        if refresh:
+            benchmark_prices = load_ticker_prices(metric_state['benchmark'])
+            if benchmark_prices is None:
+                # 沒有基準報酬時併入的 K 棒會缺少 Beta 的配對，改為直接使用已儲存的狀態
+                refresh = False
+                warning_message = f"無法讀取基準 {metric_state['benchmark']} 的價格，未併入最新的 K 棒。"
+            else:
+                benchmark_returns = benchmark_prices.pct_change().iloc[1:]
+
+        results = []
+        with span('metrics'):
+            for ticker in tickers:
+                state = states.get(ticker)
+                if refresh and (prices := load_ticker_prices(ticker)) is not None:
+                    # advance_ticker_state 回傳新的狀態，不修改各執行緒共用的快取狀態
+                    state, _ = advance_ticker_state(state, prices, benchmark_returns)
+                if state is None or window not in state['windows']:
+                    results.append({'ticker': ticker, 'error': '無指標資料'})
+                    continue
+                window_state = state['windows'][window]
+                results.append({'ticker': ticker, 'startDate': window_state['startDate'], 'endDate': window_state['endDate'],
+                                **window_metrics(window_state)})
+
+        return json_response({'benchmark': metric_state['benchmark'], 'window': window, 'data': results, 'warning': warning_message})
+    except Exception as e:
+        print(traceback.format_exc())
+        return jsonify({'error': f'無法計算指標: {str(e)}'}), 500
@@ -0,0 +1,78 @@
+# walk_forward_route.py: 專門處理滾動起點 (walk-forward) 多區間回測的 API 路由
+
+from flask import Blueprint, request, jsonify
+import traceback
+
+from ..utils.data_handler import align_prices, find_late_starts
+from ..utils.request_params import PortfolioRequest, RequestError
+from ..utils.walk_forward import build_windows, run_walk_forward
+from ..utils.instrumentation import span, json_response
+from ..utils.http_cache import conditional
+
+# --- 請求參數上限，避免單一請求產生過多區間 ---
+MAX_WINDOWS = 600
+
+# 建立一個名為 'walk_forward' 的藍圖
+walk_forward_bp = Blueprint('walk_forward', __name__)
+
+@walk_forward_bp.route('/walk-forward', methods=['POST'])
+@conditional()
+def walk_forward_handler():
+    """以多個起點 (與可選的固定長度) 回測相同的投資組合，回傳每個區間的績效指標表。"""
+    try:
+        data = request.get_json()
+        params = PortfolioRequest(data)
+
+        # stepMonths: 相鄰區間起點的間隔；windowYears: 固定區間長度，未提供時每個區間都延伸到結束日
+        step_months = int(data.get('stepMonths', 12))
+        window_years = data.get('windowYears')
+        window_years = None if window_years in (None, '') else int(window_years)
+        if step_months < 1:
+            return jsonify({'error': '區間起點的間隔必須至少為 1 個月。'}), 400
+        # 固定長度的區間不可能超過請求的範圍，先行拒絕過大的值 (也避免日期運算溢位)
+        max_window_years = params.end_date.year - params.start_date.year + 1
+        if window_years is not None and not 1 <= window_years <= max_window_years:
+            return jsonify({'error': f'區間長度必須介於 1 到 {max_window_years} 年之間。'}), 400
+
+        price_ranges = params.load_price_ranges(require_all=True)
+
+        # 所有區間共用同一段共同交易日，只對齊一次
+        with span('alignment'):
+            df_prices = align_prices(params.all_tickers, params.start_date_str, params.end_date_str, price_ranges)
+        if len(df_prices) < 2:
+            return jsonify({'error': '在指定的時間範圍內，找不到所有股票的共同交易日。'}), 400
+
+        requested_start_date = params.start_date
+        windows, skipped = build_windows(df_prices.index.values, requested_start_date, params.end_date, step_months, window_years)
+        if not windows:
+            return jsonify({'error': '在指定的時間範圍內沒有可回測的區間。'}), 400
+        if len(windows) > MAX_WINDOWS:
+            return jsonify({'error': f'區間數量 ({len(windows)}) 超過上限 {MAX_WINDOWS}，請加大起點間隔。'}), 400
+
+        warnings = []
+        if skipped:
+            problematic_tickers_info = find_late_starts(price_ranges, params.all_tickers, requested_start_date)
+            tickers_str = ", ".join([f"{item['ticker']} (從 {item['start_date']} 開始)" for item in problematic_tickers_info])
+            warnings.append(f"有 {skipped} 個區間的起點早於所有資產的共同可用日期或沒有足夠的交易日，已略過。" + (f"受影響的資產：{tickers_str}" if tickers_str else ""))
+
+        factors = params.adjustment_factors(df_prices)
+        if params.factor_warning():
+            warnings.append(params.factor_warning())
+
+        with span('simulation'):
+            results, benchmark_result = run_walk_forward(
+                df_prices, params.portfolio_configs, params.initial_amount, windows,
+                benchmark_ticker=params.benchmark_ticker, adjustment_factors=factors,
+                include_history=bool(data.get('includeHistory', False)),
+            )
+
+        return json_response({
+            'stepMonths': step_months, 'windowYears': window_years,
+            'data': results, 'benchmark': benchmark_result, 'warning': ' '.join(warnings) or None,
+        })
+
+    except RequestError as e:
+        return jsonify({'error': str(e)}), 400
+    except Exception as e:
+        print(traceback.format_exc())
+        return jsonify({'error': f'伺服器發生未預期的錯誤: {str(e)}'}), 500
@@ -0,0 +1,205 @@
+import os
+from .startup import lazy_module
+from .calculations import EPSILON, RISK_FREE_RATE, TRADING_DAYS_PER_YEAR, DAYS_PER_YEAR, _empty_metrics
+
+np = lazy_module('numpy')
+pd = lazy_module('pandas')
+
+# --- 增量指標狀態設定 ---
+# 每支股票在每個標準區間保存一組可合併的累加值 (報酬的平均與平方和、與基準的共變異、
+# 淨值高點與最大回撤)，每日新增一根 K 棒時只需併入新的報酬，不必從 1990 年重新計算。
+# 股息與分割的回溯調整只會等比例縮放過去的價格，日報酬不變，因此累加值在回溯調整後仍然有效。
+STATE_VERSION = 1
+METRIC_BENCHMARK = os.environ.get('METRIC_BENCHMARK', 'SPY')
+# 'max' 為上市以來；'ytd' 為今年以來 (跨年時重新累積)；'since_YYYY' 為自該年 1 月 1 日起
+ANCHOR_YEARS = [int(year) for year in os.environ.get('METRIC_ANCHOR_YEARS', '2000,2010,2015,2020').split(',') if year]
+STANDARD_WINDOWS = ['max', 'ytd'] + [f'since_{year}' for year in ANCHOR_YEARS]
+
+
+def window_anchor(window, last_date):
+    """區間的起始錨點 (含)；'max' 回傳 None 代表從第一根 K 棒開始。"""
+    if window == 'max':
+        return None
+    if window == 'ytd':
+        return pd.Timestamp(year=last_date.year, month=1, day=1)
+    if window.startswith('since_'):
+        return pd.Timestamp(year=int(window[len('since_'):]), month=1, day=1)
+    raise ValueError(f"不支援的指標區間: {window}")
+
+
+def _new_window(start_date):
+    return {
+        'startDate': start_date, 'endDate': start_date, 'count': 0,
+        'growth': 1.0, 'peak': 1.0, 'mdd': 0.0,
+        'mean': 0.0, 'm2': 0.0, 'downsideSquares': 0.0,
+        # 只在基準也有報酬的交易日上累積，對應 calculate_metrics 以日期交集計算 Beta
+        'benchmark': {'count': 0, 'mean': 0.0, 'benchmarkMean': 0.0, 'benchmarkM2': 0.0, 'coMoment': 0.0, 'growth': 1.0},
+    }
+
+
+def _merge_moments(count, mean, m2, new_values):
+    """以成對合併公式將新數值併入 (個數, 平均, 離差平方和)，成本只與新數值數量成正比。"""
+    new_count = len(new_values)
+    new_mean = new_values.mean()
+    total = count + new_count
+    delta = new_mean - mean
+    merged_mean = mean + delta * new_count / total
+    merged_m2 = m2 + ((new_values - new_mean) ** 2).sum() + delta ** 2 * count * new_count / total
+    return total, merged_mean, merged_m2
+
+
+def accumulate(window, returns, end_date, benchmark_returns=None, risk_free_rate=RISK_FREE_RATE):
+    """
+    將一段新的日報酬 (NumPy 陣列) 併入區間狀態，回傳新的狀態，不修改傳入的 window。
+    benchmark_returns 與 returns 等長，基準當日沒有報酬時為 NaN。
+    """
+    window = {**window, 'benchmark': dict(window['benchmark']), 'endDate': end_date}
+    if len(returns) == 0:
+        return window
+
+    previous_count, previous_mean = window['count'], window['mean']
+    window['count'], window['mean'], window['m2'] = _merge_moments(previous_count, previous_mean, window['m2'], returns)
+    daily_risk_free_rate = (1 + risk_free_rate)**(1/TRADING_DAYS_PER_YEAR) - 1
+    window['downsideSquares'] += float((np.minimum(returns - daily_risk_free_rate, 0) ** 2).sum())
+
+    # 延續先前的高點計算新報酬區段的回撤
+    path = window['growth'] * np.cumprod(1 + returns)
+    peaks = np.maximum.accumulate(np.concatenate(([window['peak']], path)))[1:]
+    window['mdd'] = min(window['mdd'], float(((path - peaks) / (peaks + EPSILON)).min()))
+    window['growth'], window['peak'] = float(path[-1]), float(peaks[-1])
+
+    if benchmark_returns is not None:
+        valid = ~np.isnan(benchmark_returns)
+        if valid.any():
+            paired, paired_benchmark = returns[valid], benchmark_returns[valid]
+            stats = window['benchmark']
+            count, new_count = stats['count'], len(paired)
+            total = count + new_count
+            delta = paired.mean() - stats['mean']
+            benchmark_delta = paired_benchmark.mean() - stats['benchmarkMean']
+            stats['coMoment'] += float(((paired - paired.mean()) * (paired_benchmark - paired_benchmark.mean())).sum()
+                                       + delta * benchmark_delta * count * new_count / total)
+            _, stats['mean'], _ = _merge_moments(count, stats['mean'], 0.0, paired)
+            stats['count'], stats['benchmarkMean'], stats['benchmarkM2'] = _merge_moments(count, stats['benchmarkMean'], stats['benchmarkM2'], paired_benchmark)
+            stats['growth'] *= float(np.prod(1 + paired_benchmark))
+    return window
+
+
+def window_metrics(window, risk_free_rate=RISK_FREE_RATE):
+    """由區間狀態計算績效指標，欄位與定義與 calculate_metrics 一致。"""
+    count = window['count']
+    if count == 0:
+        return _empty_metrics()
+    years = (pd.Timestamp(window['endDate']) - pd.Timestamp(window['startDate'])).days / DAYS_PER_YEAR
+    cagr = window['growth'] ** (1 / years) - 1 if years > 0 else 0
+    mdd = window['mdd']
+    if count < 2:
+        return _empty_metrics(cagr, mdd)
+
+    annual_std = np.sqrt(window['m2'] / (count - 1)) * np.sqrt(TRADING_DAYS_PER_YEAR)
+    annualized_excess_return = cagr - risk_free_rate
+    sharpe_ratio = annualized_excess_return / (annual_std + EPSILON)
+    downside_std = np.sqrt(window['downsideSquares'] / count) * np.sqrt(TRADING_DAYS_PER_YEAR)
+    sortino_ratio = annualized_excess_return / downside_std if downside_std > EPSILON else 0.0
+
+    beta, alpha = None, None
+    stats = window['benchmark']
+    if stats['count'] > 1 and stats['benchmarkM2'] / (stats['count'] - 1) > EPSILON:
+        beta = stats['coMoment'] / stats['benchmarkM2']
+        bench_cagr = stats['growth'] ** (1 / years) - 1 if years > 0 else 0
+        alpha = cagr - (risk_free_rate + beta * (bench_cagr - risk_free_rate))
+
+    return {'cagr': float(cagr), 'mdd': float(mdd), 'volatility': float(annual_std), 'sharpe_ratio': float(sharpe_ratio),
+            'sortino_ratio': float(sortino_ratio), 'beta': None if beta is None else float(beta),
+            'alpha': None if alpha is None else float(alpha)}
+
+
+def _accumulate_slice(window, prices, benchmark_returns):
+    """將 prices (第一筆為區間中已併入的最後一根 K 棒) 之後的報酬併入區間狀態。"""
+    returns = prices.to_numpy(dtype=float)
+    returns = returns[1:] / returns[:-1] - 1
+    paired_benchmark = None
+    if benchmark_returns is not None:
+        paired_benchmark = benchmark_returns.reindex(prices.index[1:]).to_numpy(dtype=float)
+    return accumulate(window, returns, prices.index[-1].strftime('%Y-%m-%d'), paired_benchmark)
+
+
+def advance_ticker_state(state, prices, benchmark_returns=None, windows=STANDARD_WINDOWS):
+    """
+    將價格序列中 state['lastDate'] 之後的新 K 棒併入各區間，回傳 (新狀態, 新增的 K 棒數)。
+    state 為 None、版本不符或最後日期已不在價格中 (例如數據被修訂) 時，從完整歷史重建。
+    benchmark_returns 為基準的日報酬 Series (以日期為索引)。不會修改傳入的 state。
+    """
+    prices = prices.dropna()
+    if prices.empty:
+        return None, 0
+    last_date = prices.index[-1]
+    last_date_str = last_date.strftime('%Y-%m-%d')
+
+    rebuild = (state is None or state.get('version') != STATE_VERSION
+               or pd.Timestamp(state['lastDate']) not in prices.index
+               or state['firstDate'] != prices.index[0].strftime('%Y-%m-%d'))
+    previous_windows = {} if rebuild else state['windows']
+    added_bars = len(prices) if rebuild else int((prices.index > pd.Timestamp(state['lastDate'])).sum())
+
+    new_windows = {}
+    for name in windows:
+        anchor = window_anchor(name, last_date)
+        window_prices = prices if anchor is None else prices.loc[anchor:]
+        if window_prices.empty:
+            continue
+        window_start = window_prices.index[0].strftime('%Y-%m-%d')
+        window = previous_windows.get(name)
+        if window is None or window['startDate'] != window_start:
+            # 新的區間 (或 ytd 跨年) 從區間第一根 K 棒開始累積
+            window = _new_window(window_start)
+        new_windows[name] = _accumulate_slice(window, window_prices.loc[pd.Timestamp(window['endDate']):], benchmark_returns)
+
+    return {'version': STATE_VERSION, 'firstDate': prices.index[0].strftime('%Y-%m-%d'),
+            'lastDate': last_date_str, 'windows': new_windows}, added_bars
+
+
+def update_metric_states(previous, load_prices, tickers, benchmark_ticker=METRIC_BENCHMARK):
+    """
+    更新整個股票宇宙的指標狀態。previous 為上一次儲存的狀態檔內容 (可為 None)，
+    load_prices(ticker) 回傳該股票完整的收盤價 Series，讀取失敗時回傳 None。
+    回傳 (新的狀態檔內容, 統計資訊)。
+    """
+    previous_tickers = {}
+    if previous and previous.get('version') == STATE_VERSION and previous.get('benchmark') == benchmark_ticker \
+            and previous.get('windows') == STANDARD_WINDOWS:
+        previous_tickers = previous.get('tickers', {})
+
+    benchmark_returns = None
+    benchmark_prices = load_prices(benchmark_ticker) if benchmark_ticker else None
+    if benchmark_prices is not None:
+        benchmark_returns = benchmark_prices.dropna().pct_change().iloc[1:]
+
+    summary = {'incremental': 0, 'rebuilt': 0, 'failed': 0, 'bars': 0}
+    states = {}
+    all_tickers = dict.fromkeys(list(tickers) + ([benchmark_ticker] if benchmark_ticker else []))
+    if benchmark_ticker and benchmark_prices is None:
+        # 基準讀取失敗時不推進任何股票：否則 lastDate 會越過這些 K 棒，之後再也不會與基準配對，
+        # Beta/Alpha 會與完整重建的結果永久偏離。保留上一次的狀態，下次成功時一併補上
+        for ticker in all_tickers:
+            summary['failed'] += 1
+            if previous_tickers.get(ticker) is not None:
+                states[ticker] = previous_tickers[ticker]
+        return {'version': STATE_VERSION, 'benchmark': benchmark_ticker, 'windows': STANDARD_WINDOWS, 'tickers': states}, summary
+
+    for ticker in all_tickers:
+        prices = benchmark_prices if ticker == benchmark_ticker else load_prices(ticker)
+        previous_state = previous_tickers.get(ticker)
+        state, added_bars = (None, 0) if prices is None else advance_ticker_state(previous_state, prices, benchmark_returns)
+        if state is None:
+            # 讀取失敗時保留上一次的狀態，下次成功讀取時只需併入缺少的 K 棒，不必從頭重建
+            summary['failed'] += 1
+            if previous_state is not None:
+                states[ticker] = previous_state
+            continue
+        rebuilt = previous_state is None or added_bars == len(prices.dropna())
+        summary['rebuilt' if rebuilt else 'incremental'] += 1
+        summary['bars'] += added_bars
+        states[ticker] = state
+
+    return {'version': STATE_VERSION, 'benchmark': benchmark_ticker, 'windows': STANDARD_WINDOWS, 'tickers': states}, summary
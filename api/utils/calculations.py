@@ -1,5 +1,7 @@
-import numpy as np
-import pandas as pd
+from .startup import lazy_module
+
+np = lazy_module('numpy')
+pd = lazy_module('pandas')
 
 # --- 全域常數 ---
 RISK_FREE_RATE = 0.0
@@ -7,58 +9,132 @@ TRADING_DAYS_PER_YEAR = 252
 DAYS_PER_YEAR = 365.25
 EPSILON = 1e-9
 
+def _empty_metrics(cagr=0, mdd=0):
+    return {'cagr': cagr, 'mdd': mdd, 'volatility': 0, 'sharpe_ratio': 0, 'sortino_ratio': 0, 'beta': None, 'alpha': None}
+
+def _daily_returns(values, dates):
+    """計算日報酬 (等同 pct_change().dropna())，回傳報酬與對應日期的 NumPy 陣列。"""
+    with np.errstate(divide='ignore', invalid='ignore'):
+        returns = values[1:] / values[:-1] - 1
+    return_dates = dates[1:]
+    valid = ~np.isnan(returns)
+    if not valid.all():
+        returns = returns[valid]
+        return_dates = return_dates[valid]
+    return returns, return_dates
+
+def prepare_benchmark(benchmark_history):
+    """
+    預先計算基準的日報酬，供多次 calculate_metrics 共用 (例如掃描時每支股票都對同一個基準計算 Beta)。
+    回傳 None 代表沒有可用的基準。
+    """
+    if benchmark_history is None or isinstance(benchmark_history, dict):
+        return benchmark_history
+    if benchmark_history.empty:
+        return None
+    values = benchmark_history['value'].to_numpy(dtype=float)
+    returns, return_dates = _daily_returns(values, benchmark_history.index.values)
+    return {'returns': returns, 'dates': return_dates, 'start_value': values[0], 'end_value': values[-1]}
+
 def calculate_metrics(portfolio_history, benchmark_history=None, risk_free_rate=RISK_FREE_RATE):
     """
     計算績效指標，包含 CAGR, MDD, Volatility, Sharpe, Sortino, Beta, Alpha。
+    benchmark_history 可以是含 'value' 欄位的 DataFrame，或 prepare_benchmark 的結果。
+    不會修改傳入的 DataFrame。
     """
     if portfolio_history.empty or len(portfolio_history) < 2:
-        return {'cagr': 0, 'mdd': 0, 'volatility': 0, 'sharpe_ratio': 0, 'sortino_ratio': 0, 'beta': None, 'alpha': None}
-    
-    end_value = portfolio_history['value'].iloc[-1]
-    start_value = portfolio_history['value'].iloc[0]
+        return _empty_metrics()
+
+    years = (portfolio_history.index[-1] - portfolio_history.index[0]).days / DAYS_PER_YEAR
+    return calculate_metrics_from_arrays(
+        portfolio_history['value'].to_numpy(dtype=float), portfolio_history.index.values, years,
+        prepare_benchmark(benchmark_history), risk_free_rate
+    )
+
+def years_between(start_date, end_date):
+    """兩個 datetime64 日期之間的年數 (與 Timestamp 相減後取 .days 的結果一致)。"""
+    return int((end_date - start_date) // np.timedelta64(1, 'D')) / DAYS_PER_YEAR
+
+def calculate_column_metrics(values, dates, columns, tickers, benchmark=None):
+    """
+    對價格矩陣中的多個欄位逐一計算績效指標 (各欄位先移除缺值)，依 tickers 順序回傳。
+    計算失敗的欄位以 None 表示。此函式也作為多核心掃描時子行程的工作函式。
+    """
+    column_positions = {column: i for i, column in enumerate(columns)}
+    results = []
+    for ticker in tickers:
+        try:
+            column = values[:, column_positions[ticker]]
+            valid = ~np.isnan(column)
+            stock_values, stock_dates = column[valid], dates[valid]
+            if len(stock_values) < 2:
+                results.append(_empty_metrics())
+                continue
+            years = years_between(stock_dates[0], stock_dates[-1])
+            results.append(calculate_metrics_from_arrays(stock_values, stock_dates, years, benchmark))
+        except Exception as e:
+            print(f"處理 {ticker} 時發生錯誤: {e}")
+            results.append(None)
+    return results
+
+def calculate_metrics_from_arrays(values, dates, years, benchmark=None, risk_free_rate=RISK_FREE_RATE):
+    """
+    以 NumPy 陣列計算績效指標的核心，不經過 pandas。
+    values 為淨值序列，dates 為對應的 datetime64 陣列，benchmark 為 prepare_benchmark 的結果。
+    """
+    if len(values) < 2:
+        return _empty_metrics()
+
+    start_value = values[0]
+    end_value = values[-1]
     if start_value < EPSILON:
-        return {'cagr': 0, 'mdd': -1, 'volatility': 0, 'sharpe_ratio': 0, 'sortino_ratio': 0, 'beta': None, 'alpha': None}
+        return _empty_metrics(mdd=-1)
 
-    start_date = portfolio_history.index[0]
-    end_date = portfolio_history.index[-1]
-    years = (end_date - start_date).days / DAYS_PER_YEAR
     cagr = (end_value / start_value) ** (1 / years) - 1 if years > 0 else 0
 
-    portfolio_history['peak'] = portfolio_history['value'].cummax()
-    portfolio_history['drawdown'] = (portfolio_history['value'] - portfolio_history['peak']) / (portfolio_history['peak'] + EPSILON)
-    mdd = portfolio_history['drawdown'].min()
+    # 滾動高點與回撤 (fmax 會略過 NaN，與 pandas cummax 行為一致)
+    peak = np.fmax.accumulate(values)
+    mdd = np.nanmin((values - peak) / (peak + EPSILON))
 
-    daily_returns = portfolio_history['value'].pct_change().dropna()
-    if len(daily_returns) < 2:
-        return {'cagr': cagr, 'mdd': mdd, 'volatility': 0, 'sharpe_ratio': 0, 'sortino_ratio': 0, 'beta': None, 'alpha': None}
+    daily_returns, return_dates = _daily_returns(values, dates)
+    count = len(daily_returns)
+    if count < 2:
+        return _empty_metrics(cagr, mdd)
 
-    annual_std = daily_returns.std() * np.sqrt(TRADING_DAYS_PER_YEAR)
+    mean_return = daily_returns.mean()
+    deviations = daily_returns - mean_return
+    annual_std = np.sqrt(deviations @ deviations / (count - 1)) * np.sqrt(TRADING_DAYS_PER_YEAR)
     annualized_excess_return = cagr - risk_free_rate
     sharpe_ratio = annualized_excess_return / (annual_std + EPSILON)
 
     daily_risk_free_rate = (1 + risk_free_rate)**(1/TRADING_DAYS_PER_YEAR) - 1
-    downside_returns = daily_returns - daily_risk_free_rate
-    downside_returns[downside_returns > 0] = 0
-    downside_std = np.sqrt((downside_returns**2).mean()) * np.sqrt(TRADING_DAYS_PER_YEAR)
-    
+    downside_returns = np.minimum(daily_returns - daily_risk_free_rate, 0)
+    downside_std = np.sqrt(downside_returns @ downside_returns / count) * np.sqrt(TRADING_DAYS_PER_YEAR)
+
     sortino_ratio = 0.0
     if downside_std > EPSILON:
         sortino_ratio = annualized_excess_return / downside_std
 
     beta, alpha = None, None
-    if benchmark_history is not None and not benchmark_history.empty:
-        benchmark_returns = benchmark_history['value'].pct_change().dropna()
-        aligned_returns = pd.concat([daily_returns, benchmark_returns], axis=1, join='inner')
-        aligned_returns.columns = ['portfolio', 'benchmark']
-        if len(aligned_returns) > 1:
-            covariance_matrix = aligned_returns.cov()
-            covariance = covariance_matrix.iloc[0, 1]
-            benchmark_variance = covariance_matrix.iloc[1, 1]
+    if benchmark is not None and len(benchmark['returns']) > 0:
+        benchmark_returns = benchmark['returns']
+        if len(benchmark_returns) == count and np.array_equal(benchmark['dates'], return_dates):
+            # 日期完全相同 (回測中的常見情況)，可直接沿用已算好的離差
+            portfolio_deviations = deviations
+            aligned_benchmark = benchmark_returns
+        else:
+            _, portfolio_idx, benchmark_idx = np.intersect1d(return_dates, benchmark['dates'], assume_unique=True, return_indices=True)
+            aligned_portfolio = daily_returns[portfolio_idx]
+            aligned_benchmark = benchmark_returns[benchmark_idx]
+            portfolio_deviations = aligned_portfolio - aligned_portfolio.mean() if len(aligned_portfolio) else aligned_portfolio
+        aligned_count = len(aligned_benchmark)
+        if aligned_count > 1:
+            benchmark_deviations = aligned_benchmark - aligned_benchmark.mean()
+            covariance = portfolio_deviations @ benchmark_deviations / (aligned_count - 1)
+            benchmark_variance = benchmark_deviations @ benchmark_deviations / (aligned_count - 1)
             if benchmark_variance > EPSILON:
                 beta = covariance / benchmark_variance
-                bench_end_value = benchmark_history['value'].iloc[-1]
-                bench_start_value = benchmark_history['value'].iloc[0]
-                bench_cagr = (bench_end_value / bench_start_value) ** (1 / years) - 1 if years > 0 else 0
+                bench_cagr = (benchmark['end_value'] / benchmark['start_value']) ** (1 / years) - 1 if years > 0 else 0
                 expected_return = risk_free_rate + beta * (bench_cagr - risk_free_rate)
                 alpha = cagr - expected_return
 
@@ -1,65 +1,262 @@
+from __future__ import annotations
+
 import os
-import pandas as pd
-from pandas.tseries.offsets import BDay
-from cachetools import cached, TTLCache
+import functools
+from cachetools.keys import hashkey
+import hashlib
+import io
 import json
-import requests # 改用 requests 來獲取 JSON，更穩健
+from .startup import lazy_module
+from .instrumentation import span, record_cache
+from .single_flight import SingleFlightCache
+
+# pandas 與 requests 延遲到第一次使用時才匯入，以縮短 serverless 冷啟動時間
+np = lazy_module('numpy')
+pd = lazy_module('pandas')
+requests = lazy_module('requests') # 改用 requests 來獲取 JSON，更穩健
 
 # --- 快取設定 ---
-cache = TTLCache(maxsize=256, ttl=1800) # 快取 30 分鐘
+# 預設快取 30 分鐘，過期後 30 分鐘內先回傳舊值並在背景更新；讀取失敗只快取 30 秒 (見 single_flight.py)
+cache = SingleFlightCache(maxsize=256)
+# 價格以股票為單位快取，容量需涵蓋整個掃描宇宙，否則大型掃描會不斷互相淘汰
+price_cache = SingleFlightCache(maxsize=int(os.environ.get('PRICE_CACHE_SIZE', 1024)))
+_MISSING = object()
+# 每次遠端讀取的逾時秒數；沒有逾時的讀取一旦卡住，會讓等待同一個快取鍵的所有請求一起卡住
+DATA_FETCH_TIMEOUT = float(os.environ.get('DATA_FETCH_TIMEOUT', 30))
+
+# 各報酬基礎對應的價格表欄位；總報酬 ('total') 直接使用 Close，不需要調整
+ADJUSTMENT_FACTOR_COLUMNS = {'price': 'PriceFactor'}
+
+def instrumented_cached(cache_name, store=cache, fallback=_MISSING):
+    """
+    以 SingleFlightCache 快取函式結果：同一個鍵同時只會載入一次，其他請求等待並共用結果。
+    記錄每次查詢的結果 (hit / stale / coalesced / miss)，並將快取查詢與載入 (含等待其他請求的載入)
+    分別計入 cache_lookup 與 fetch 兩個 span。
+    函式拋出例外代表讀取失敗，失敗只會短暫快取；有提供 fallback 時改為回傳 fallback。
+    """
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            key = hashkey(cache_name, *args, **kwargs)
+            loader = functools.partial(func, *args, **kwargs)
+            try:
+                with span('cache_lookup'):
+                    found, value, result = store.peek(key, loader)
+                if not found:
+                    with span('fetch'):
+                        value, result = store.load(key, loader)
+            except Exception:
+                record_cache(cache_name, 'error')
+                if fallback is _MISSING:
+                    raise
+                return fallback
+            record_cache(cache_name, result)
+            return value
+        wrapper.cache_clear = store.clear
+        # 供非同步預先載入 (api/asgi.py) 檢查與寫入同一個快取鍵
+        wrapper.cache_contains = lambda *args, **kwargs: store.contains(hashkey(cache_name, *args, **kwargs))
+        wrapper.cache_set = lambda value, *args, **kwargs: store.set(hashkey(cache_name, *args, **kwargs), value)
+        return wrapper
+    return decorator
+
+def data_url(path):
+    """
+    數據檔案的完整 URL。預設為 GitHub data 分支的 raw URL；
+    設定 DATA_BASE_URL 可改用其他來源 (例如 CDN 或負載測試用的本地數據伺服器)。
+    """
+    base_url = os.environ.get('DATA_BASE_URL')
+    if not base_url:
+        # 使用 Render 的環境變數，並更新後備值為您最新的專案名稱
+        owner = os.environ.get('RENDER_GIT_REPO_OWNER', 'chihung1024') 
+        repo = os.environ.get('RENDER_GIT_REPO_SLUG', 'Backtest') # <-- 確認後備值為 'Backtest'
+        base_url = f"https://raw.githubusercontent.com/{owner}/{repo}/data"
+    return f"{base_url.rstrip('/')}/{path}"
+
+
+def parse_ticker_csv(ticker, source):
+    """
+    解析單一股票的價格 CSV (URL、路徑或檔案物件)，保留收盤價 (總報酬，欄位名稱為股票代碼)
+    與可用的調整因子欄位，並移除缺值、依日期排序。
+    """
+    df = pd.read_csv(source, index_col='Date', parse_dates=True)
+    columns = ['Close'] + [column for column in ADJUSTMENT_FACTOR_COLUMNS.values() if column in df.columns]
+    return df[columns].rename(columns={'Close': ticker}).dropna(subset=[ticker]).sort_index()
+
+
+@instrumented_cached('ticker_prices', price_cache, fallback=None)
+def load_ticker_history(ticker: str) -> pd.DataFrame | None:
+    """
+    從遠端 GitHub data 分支的 raw URL 讀取單一股票的完整價格歷史 (已移除缺值)。
+    回傳的 DataFrame 以股票代碼為收盤價 (總報酬) 欄位名稱；若 CSV 含有 PriceFactor 欄位也一併保留。
+    以股票為單位快取，不同日期區間與股票組合的請求可共用同一份數據。
+    讀取失敗時回傳 None。
+    """
+    file_url = data_url(f"prices/{ticker}.csv")
+    try:
+        response = requests.get(file_url, timeout=DATA_FETCH_TIMEOUT)
+        response.raise_for_status()
+        return parse_ticker_csv(ticker, io.BytesIO(response.content))
+    except Exception as e:
+        # (新增) 印出更詳細的錯誤日誌，告訴我們是哪個 URL 失敗了
+        print(f"警告：無法從 URL [{file_url}] 讀取股票 {ticker} 的價格檔案: {e}")
+        raise
+
+
+def load_ticker_prices(ticker: str) -> pd.Series | None:
+    """單一股票的完整收盤價 (總報酬) 序列，名稱為股票代碼。"""
+    history = load_ticker_history(ticker)
+    return None if history is None else history[ticker]
+
+
+def load_adjustment_factors(tickers, index, return_basis):
+    """
+    回傳將總報酬收盤價轉換為指定報酬基礎所需的累積調整因子，對齊至 index。
+    回傳 (factors, missing_tickers)：'total' 不需要調整時 factors 為 None；
+    缺少因子欄位的舊版數據以 1 代替 (即維持總報酬)，並列在 missing_tickers 中。
+    """
+    factor_column = ADJUSTMENT_FACTOR_COLUMNS.get(return_basis)
+    if factor_column is None:
+        return None, []
+
+    factors, missing_tickers = {}, []
+    for ticker in dict.fromkeys(tickers):
+        history = load_ticker_history(ticker)
+        if history is None or factor_column not in history.columns:
+            missing_tickers.append(ticker)
+            factors[ticker] = np.ones(len(index))
+        else:
+            factors[ticker] = history[factor_column].reindex(index).to_numpy(dtype=float)
+    return pd.DataFrame(factors, index=index), missing_tickers
+
+
+def get_price_ranges(tickers) -> dict:
+    """
+    回傳每支股票第一個與最後一個有效日期的索引：{ticker: (first_valid_date, last_valid_date)}。
+    讀取失敗或沒有數據的股票不會出現在結果中。
+    """
+    price_ranges = {}
+    for ticker in tickers:
+        prices = load_ticker_prices(ticker)
+        if prices is not None and not prices.empty:
+            price_ranges[ticker] = (prices.index[0], prices.index[-1])
+    return price_ranges
+
+
+def common_window(price_ranges, tickers, start_date, end_date):
+    """
+    只根據有效日期索引計算多支股票的共同區間，不需要讀取或合併任何價格。
+    回傳 (window_start, window_end)；沒有共同區間時回傳 None。
+    """
+    ranges = [price_ranges[ticker] for ticker in tickers if ticker in price_ranges]
+    if not ranges:
+        return None
+    window_start = max([pd.Timestamp(start_date)] + [first for first, _ in ranges])
+    window_end = min([pd.Timestamp(end_date)] + [last for _, last in ranges])
+    if window_start > window_end:
+        return None
+    return window_start, window_end
+
+
+def align_prices(tickers, start_date, end_date, price_ranges=None) -> pd.DataFrame:
+    """
+    回傳 tickers 在 [start_date, end_date] 內所有股票皆有價格的交易日 (等同合併後 dropna)。
+    先以有效日期索引算出共同區間，再只切出該區間的列與需要的欄位，
+    避免先合併所有股票的完整歷史，成本只與輸出大小成正比。
+    """
+    if price_ranges is None:
+        price_ranges = get_price_ranges(tickers)
+    available = [ticker for ticker in dict.fromkeys(tickers) if ticker in price_ranges]
+    window = common_window(price_ranges, available, start_date, end_date)
+    if window is None:
+        return pd.DataFrame()
+
+    window_start, window_end = window
+    slices = []
+    for ticker in available:
+        prices = load_ticker_prices(ticker)
+        # 索引已排序，切片以二分搜尋定位，不會掃描整段歷史
+        slices.append(prices.loc[window_start:window_end])
+
+    first_index = slices[0].index
+    if all(len(s) == len(first_index) and s.index.equals(first_index) for s in slices[1:]):
+        # 所有股票的交易日完全相同 (常見情況)，直接組成 DataFrame
+        return pd.DataFrame({s.name: s.to_numpy() for s in slices}, index=first_index)
+    return pd.concat(slices, axis=1, join='inner')
+
 
-@cached(cache)
 def read_price_data_from_repo(tickers: tuple, start_date_str: str, end_date_str: str) -> pd.DataFrame:
     """
-    從遠端 GitHub data 分支的 raw URL 讀取 CSV 檔案。
+    讀取多支股票在日期區間內的價格，並以所有日期的聯集合併 (缺值保留為 NaN)。
+    每支股票先切出所需區間再合併，不會產生完整歷史的中間表。
     """
-    # 使用 Render 的環境變數，並更新後備值為您最新的專案名稱
-    owner = os.environ.get('RENDER_GIT_REPO_OWNER', 'chihung1024') 
-    repo = os.environ.get('RENDER_GIT_REPO_SLUG', 'Backtest') # <-- 確認後備值為 'Backtest'
-    
-    base_url = f"https://raw.githubusercontent.com/{owner}/{repo}/data/prices"
-    
+    start_date, end_date = pd.Timestamp(start_date_str), pd.Timestamp(end_date_str)
     all_prices = []
-    print(f"--- 開始從 {base_url} 讀取價格數據 ---") # 新增日誌
     for ticker in tickers:
-        file_url = f"{base_url}/{ticker}.csv"
-        try:
-            df = pd.read_csv(file_url, index_col='Date', parse_dates=True)
-            df.rename(columns={'Close': ticker}, inplace=True)
-            all_prices.append(df)
-        except Exception as e:
-            # (新增) 印出更詳細的錯誤日誌，告訴我們是哪個 URL 失敗了
-            print(f"警告：無法從 URL [{file_url}] 讀取股票 {ticker} 的價格檔案: {e}")
+        prices = load_ticker_prices(ticker)
+        if prices is not None:
+            all_prices.append(prices.loc[start_date:end_date])
 
     if not all_prices:
         print("--- 警告：未能讀取到任何價格數據 ---") # 新增日誌
         return pd.DataFrame()
 
-    print(f"--- 成功讀取 {len(all_prices)} 支股票的價格數據 ---") # 新增日誌
-    combined_df = pd.concat(all_prices, axis=1)
-    mask = (combined_df.index >= start_date_str) & (combined_df.index <= end_date_str)
-    return combined_df.loc[mask]
+    return pd.concat(all_prices, axis=1)
 
 
-@cached(cache)
+@instrumented_cached('preprocessed', fallback=[])
 def get_preprocessed_data():
     """
     從遠端 GitHub data 分支的 raw URL 讀取預處理好的 JSON 數據。
+    讀取失敗時回傳空列表 (失敗只快取很短的時間，之後的請求會重試)。
     """
-    # 使用 Render 的環境變數，並更新後備值為您最新的專案名稱
-    owner = os.environ.get('RENDER_GIT_REPO_OWNER', 'chihung1024') 
-    repo = os.environ.get('RENDER_GIT_REPO_SLUG', 'Backtest') # <-- 確認後備值為 'Backtest'
-    url = f"https://raw.githubusercontent.com/{owner}/{repo}/data/preprocessed_data.json"
+    url = data_url("preprocessed_data.json")
     
     print(f"--- 正在從 URL [{url}] 讀取預處理數據 ---") # 新增日誌
     try:
-        response = requests.get(url)
+        response = requests.get(url, timeout=DATA_FETCH_TIMEOUT)
         response.raise_for_status()  # 如果請求失敗 (如 404)，會在此拋出錯誤
         return response.json()
     except Exception as e:
         # (新增) 印出詳細的錯誤日誌
         print(f"致命錯誤：無法從 URL [{url}] 讀取 preprocessed_data.json: {e}")
-        return []
+        raise
+
+
+@instrumented_cached('data_version', fallback='unavailable')
+def get_data_version():
+    """
+    目前數據快照的版本 (用於 HTTP ETag)，讀取 data 分支上由 update_data.py 寫入的 version.json。
+    舊的數據分支沒有此檔時，以預處理數據內容的雜湊代替 (兩者由同一次排程更新)。
+    版本與數據使用相同的快取 TTL，因此 ETag 不會比回應所依據的數據新太久。
+    """
+    url = data_url("version.json")
+    try:
+        response = requests.get(url, timeout=DATA_FETCH_TIMEOUT)
+        response.raise_for_status()
+        return str(response.json()['version'])
+    except Exception as e:
+        print(f"警告：無法從 URL [{url}] 讀取 version.json，改用預處理數據的雜湊: {e}")
+        preprocessed_data = get_preprocessed_data()
+        if not preprocessed_data:
+            raise
+        content = json.dumps(preprocessed_data, sort_keys=True, ensure_ascii=False)
+        return hashlib.sha256(content.encode('utf-8')).hexdigest()[:16]
+
+
+@instrumented_cached('metric_state', fallback=None)
+def get_metric_state():
+    """
+    從遠端 GitHub data 分支讀取 update_data.py 產生的增量指標狀態 (metric_state.json)。
+    讀取失敗時回傳 None。
+    """
+    url = data_url("metric_state.json")
+    try:
+        response = requests.get(url, timeout=DATA_FETCH_TIMEOUT)
+        response.raise_for_status()
+        return response.json()
+    except Exception as e:
+        print(f"警告：無法從 URL [{url}] 讀取 metric_state.json: {e}")
+        raise
 
 
 def validate_data_completeness(df_prices_raw, all_tickers, requested_start_date):
@@ -70,6 +267,19 @@ def validate_data_completeness(df_prices_raw, all_tickers, requested_start_date)
     for ticker in all_tickers:
         if ticker in df_prices_raw.columns:
             first_valid_date = df_prices_raw[ticker].first_valid_index()
-            if first_valid_date is not None and first_valid_date > requested_start_date + BDay(5):
+            if first_valid_date is not None and first_valid_date > requested_start_date + pd.offsets.BDay(5):
+                problematic_tickers.append({'ticker': ticker, 'start_date': first_valid_date.strftime('%Y-%m-%d')})
+    return problematic_tickers
+
+
+def find_late_starts(price_ranges, tickers, requested_start_date):
+    """
+    與 validate_data_completeness 相同的檢查，但只使用有效日期索引，不需要價格數據。
+    """
+    problematic_tickers = []
+    for ticker in tickers:
+        if ticker in price_ranges:
+            first_valid_date = price_ranges[ticker][0]
+            if first_valid_date > requested_start_date + pd.offsets.BDay(5):
                 problematic_tickers.append({'ticker': ticker, 'start_date': first_valid_date.strftime('%Y-%m-%d')})
     return problematic_tickers
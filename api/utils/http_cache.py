@@ -0,0 +1,122 @@
+import functools
+import gzip
+import hashlib
+import json
+import os
+from flask import make_response, request
+from .data_handler import get_data_version
+from .instrumentation import debug_requested, span
+
+try:
+    import brotli  # 選用套件，未安裝時只使用 gzip
+except ImportError:
+    brotli = None
+
+# --- HTTP 快取設定 ---
+# 小於此大小的回應不壓縮，壓縮的 CPU 成本大於節省的傳輸量
+COMPRESSION_MIN_BYTES = int(os.environ.get('COMPRESSION_MIN_BYTES', 1024))
+GZIP_LEVEL = 6
+BROTLI_QUALITY = 5
+COMPRESSIBLE_MIMETYPES = ('application/json', 'text/plain', 'text/html', 'text/css', 'application/javascript')
+# 數據衍生的 GET 回應：瀏覽器快取 max-age 秒，CDN 快取 s-maxage 秒 (與後端數據快取的 TTL 相同)
+BROWSER_MAX_AGE = int(os.environ.get('BROWSER_CACHE_MAX_AGE', 300))
+CDN_MAX_AGE = int(os.environ.get('CDN_CACHE_MAX_AGE', 1800))
+# 部署版本也納入 ETag，回應格式改變後舊的 ETag 會自動失效
+BUILD_VERSION = os.environ.get('VERCEL_GIT_COMMIT_SHA') or os.environ.get('RENDER_GIT_COMMIT') or ''
+# 壓縮後的 ETag 加上編碼後綴，讓不同編碼的內容有不同的強 ETag
+ENCODING_SUFFIXES = {'br': '-br', 'gzip': '-gz'}
+
+
+def request_fingerprint():
+    """請求內容的雜湊：方法、路徑、排序後的查詢參數與正規化的 JSON 本文 (鍵的順序與空白不影響結果)。"""
+    query = sorted((key, value) for key, value in request.args.items(multi=True) if key != 'debug')
+    body = request.get_json(silent=True) if request.method == 'POST' else None
+    canonical = json.dumps([request.method, request.path, query, body], sort_keys=True, separators=(',', ':'), ensure_ascii=False)
+    return hashlib.sha256(canonical.encode('utf-8')).hexdigest()
+
+
+def make_etag():
+    """由數據版本、部署版本與請求內容產生的強 ETag (不含引號)。"""
+    return hashlib.sha256(f'{get_data_version()}:{BUILD_VERSION}:{request_fingerprint()}'.encode('utf-8')).hexdigest()[:32]
+
+
+def _strip_encoding_suffix(etag):
+    for suffix in ENCODING_SUFFIXES.values():
+        if etag.endswith(suffix):
+            return etag[:-len(suffix)]
+    return etag
+
+
+def conditional(shared=False):
+    """
+    為數據衍生的端點加上 ETag 與條件式請求。
+    If-None-Match 符合時直接回傳 304，不執行處理函式；只有 200 的回應會附上 ETag 與 Cache-Control。
+    shared=True 代表回應可被 CDN 與瀏覽器快取 (GET)；否則每次都需要以 ETag 重新驗證 (POST)。
+    要求計時除錯資訊的請求不參與快取。
+    """
+    cache_control = f'public, max-age={BROWSER_MAX_AGE}, s-maxage={CDN_MAX_AGE}' if shared else 'private, no-cache'
+
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            if debug_requested():
+                return func(*args, **kwargs)
+            with span('etag'):
+                etag = make_etag()
+                # 304 回傳用戶端持有的 ETag 原文 (可能帶有編碼後綴)，與當初 200 回應的 ETag 一致
+                matched = next((tag for tag in request.if_none_match.as_set() if _strip_encoding_suffix(tag) == etag), None)
+            if matched is not None:
+                response = make_response('', 304)
+                response.set_etag(matched)
+            else:
+                response = make_response(func(*args, **kwargs))
+                if response.status_code != 200:
+                    return response
+                response.set_etag(etag)
+            response.headers['Cache-Control'] = cache_control
+            return response
+        return wrapper
+    return decorator
+
+
+def _choose_encoding():
+    accepted = request.accept_encodings
+    if brotli is not None and accepted['br']:
+        return 'br'
+    if accepted['gzip']:
+        return 'gzip'
+    return None
+
+
+def _compress(response):
+    """壓縮超過大小門檻的文字回應，並讓 ETag 反映內容編碼。"""
+    response.vary.add('Accept-Encoding')
+    if (response.status_code != 200 or response.direct_passthrough or 'Content-Encoding' in response.headers
+            or response.mimetype not in COMPRESSIBLE_MIMETYPES):
+        return response
+    encoding = _choose_encoding()
+    if encoding is None:
+        return response
+    body = response.get_data()
+    if len(body) < COMPRESSION_MIN_BYTES:
+        return response
+
+    with span('compression'):
+        if encoding == 'br':
+            compressed = brotli.compress(body, quality=BROTLI_QUALITY)
+        else:
+            compressed = gzip.compress(body, compresslevel=GZIP_LEVEL, mtime=0)
+    response.set_data(compressed)
+    response.headers['Content-Encoding'] = encoding
+    etag, weak = response.get_etag()
+    if etag and not weak:
+        response.set_etag(etag + ENCODING_SUFFIXES[encoding])
+    return response
+
+
+def init_http_cache(app):
+    """
+    註冊回應壓縮的掛鉤。須在 init_instrumentation 之後呼叫：
+    after_request 依註冊的相反順序執行，壓縮才會在計時統計之前完成並計入 compression span。
+    """
+    app.after_request(_compress)
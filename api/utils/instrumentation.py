@@ -0,0 +1,180 @@
+import json
+import threading
+import time
+from contextlib import contextmanager
+from flask import g, has_request_context, jsonify, request
+
+# --- 效能觀測設定 ---
+# 所有統計都存放在行程記憶體中 (每個 gunicorn worker 各自一份)，
+# 只在請求結束時更新一次直方圖，單次 span 的成本只有兩次 perf_counter 與一次 dict 更新，可在正式環境常駐開啟。
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+METRIC_PREFIX = 'backtest'
+
+_lock = threading.Lock()
+_request_histograms = {}  # endpoint -> _Histogram
+_span_histograms = {}     # (endpoint, span) -> _Histogram
+_request_counts = {}      # (endpoint, status) -> int
+_cache_counts = {}        # (cache, 'hit' | 'stale' | 'coalesced' | 'miss' | 'error') -> int
+# 不需要自行讀取遠端的查詢結果：hit (新鮮)、stale (先回傳舊值並在背景更新)、coalesced (共用其他請求的載入)
+CACHE_SERVED_RESULTS = ('hit', 'stale', 'coalesced')
+
+
+class _Histogram:
+    """累積式延遲直方圖 (Prometheus histogram 語意)。"""
+
+    def __init__(self):
+        self.bucket_counts = [0] * len(LATENCY_BUCKETS)
+        self.total = 0.0
+        self.count = 0
+
+    def observe(self, seconds):
+        for i, upper_bound in enumerate(LATENCY_BUCKETS):
+            if seconds <= upper_bound:
+                self.bucket_counts[i] += 1
+                break
+        self.total += seconds
+        self.count += 1
+
+
+@contextmanager
+def span(name):
+    """
+    量測一段程式碼的耗時並累加到目前請求的計時明細中。
+    同名 span 在同一請求中會累加 (例如掃描時每支股票的 metrics)。
+    不在請求內 (例如離線腳本或子行程) 時不做任何事。
+    """
+    if not has_request_context():
+        yield
+        return
+    start_time = time.perf_counter()
+    try:
+        yield
+    finally:
+        elapsed = time.perf_counter() - start_time
+        spans = g.setdefault('_spans', {})
+        entry = spans.get(name)
+        if entry is None:
+            spans[name] = [elapsed, 1]
+        else:
+            entry[0] += elapsed
+            entry[1] += 1
+
+
+def record_cache(cache_name, result):
+    """記錄一次快取查詢的結果 ('hit' | 'stale' | 'coalesced' | 'miss' | 'error')。"""
+    key = (cache_name, result)
+    with _lock:
+        _cache_counts[key] = _cache_counts.get(key, 0) + 1
+
+
+def debug_requested():
+    """請求是否要求在回應中附上計時明細 (?debug=timing 或 X-Debug-Timing 標頭)。"""
+    return request.args.get('debug') == 'timing' or request.headers.get('X-Debug-Timing') is not None
+
+
+def timing_breakdown():
+    """目前請求中各 span 的耗時明細 (毫秒)。"""
+    spans = g.get('_spans', {})
+    return {name: {'ms': round(total * 1000, 3), 'count': count} for name, (total, count) in spans.items()}
+
+
+def json_response(payload):
+    """
+    將回應序列化為 JSON 並計入 serialization span。
+    若請求要求除錯資訊，物件回應會附上 debug.timings 區段；
+    其他回應 (例如 /api/scan 的列表) 不改變格式，改以 X-Debug-Timings 標頭 (JSON) 提供相同的明細。
+    """
+    debug_timings = None
+    if debug_requested():
+        if isinstance(payload, dict):
+            payload = {**payload, 'debug': {'timings': timing_breakdown()}}
+        else:
+            debug_timings = timing_breakdown()
+    with span('serialization'):
+        response = jsonify(payload)
+    if debug_timings is not None:
+        response.headers['X-Debug-Timings'] = json.dumps(debug_timings, separators=(',', ':'))
+    return response
+
+
+def _before_request():
+    g._request_start_time = time.perf_counter()
+
+
+def _after_request(response):
+    start_time = g.get('_request_start_time')
+    if start_time is None:
+        return response
+    total = time.perf_counter() - start_time
+    spans = g.get('_spans', {})
+
+    timing_parts = [f'{name};dur={elapsed * 1000:.2f}' for name, (elapsed, _count) in spans.items()]
+    timing_parts.append(f'total;dur={total * 1000:.2f}')
+    response.headers['Server-Timing'] = ', '.join(timing_parts)
+
+    endpoint = request.endpoint or 'unknown'
+    with _lock:
+        _request_histograms.setdefault(endpoint, _Histogram()).observe(total)
+        for name, (elapsed, _count) in spans.items():
+            _span_histograms.setdefault((endpoint, name), _Histogram()).observe(elapsed)
+        count_key = (endpoint, response.status_code)
+        _request_counts[count_key] = _request_counts.get(count_key, 0) + 1
+    return response
+
+
+def init_instrumentation(app):
+    """在 Flask 應用上註冊請求計時的掛鉤。"""
+    app.before_request(_before_request)
+    app.after_request(_after_request)
+
+
+def _format_labels(labels):
+    return ','.join(f'{key}="{value}"' for key, value in labels.items())
+
+
+def _render_histogram(lines, name, labels, histogram):
+    cumulative = 0
+    for upper_bound, bucket_count in zip(LATENCY_BUCKETS, histogram.bucket_counts):
+        cumulative += bucket_count
+        lines.append(f'{name}_bucket{{{_format_labels({**labels, "le": upper_bound})}}} {cumulative}')
+    lines.append(f'{name}_bucket{{{_format_labels({**labels, "le": "+Inf"})}}} {histogram.count}')
+    lines.append(f'{name}_sum{{{_format_labels(labels)}}} {histogram.total}')
+    lines.append(f'{name}_count{{{_format_labels(labels)}}} {histogram.count}')
+
+
+def render_prometheus():
+    """以 Prometheus 文字格式輸出目前行程的所有統計。"""
+    lines = []
+    with _lock:
+        name = f'{METRIC_PREFIX}_request_duration_seconds'
+        lines.append(f'# HELP {name} API 請求的總耗時。')
+        lines.append(f'# TYPE {name} histogram')
+        for endpoint, histogram in sorted(_request_histograms.items()):
+            _render_histogram(lines, name, {'endpoint': endpoint}, histogram)
+
+        name = f'{METRIC_PREFIX}_span_duration_seconds'
+        lines.append(f'# HELP {name} 每個請求中各階段 (span) 的累計耗時。')
+        lines.append(f'# TYPE {name} histogram')
+        for (endpoint, span_name), histogram in sorted(_span_histograms.items()):
+            _render_histogram(lines, name, {'endpoint': endpoint, 'span': span_name}, histogram)
+
+        name = f'{METRIC_PREFIX}_requests_total'
+        lines.append(f'# HELP {name} 依端點與狀態碼統計的請求數。')
+        lines.append(f'# TYPE {name} counter')
+        for (endpoint, status), count in sorted(_request_counts.items()):
+            lines.append(f'{name}{{{_format_labels({"endpoint": endpoint, "status": status})}}} {count}')
+
+        name = f'{METRIC_PREFIX}_cache_requests_total'
+        lines.append(f'# HELP {name} 快取查詢次數 (依結果分類)。')
+        lines.append(f'# TYPE {name} counter')
+        for (cache_name, result), count in sorted(_cache_counts.items()):
+            lines.append(f'{name}{{{_format_labels({"cache": cache_name, "result": result})}}} {count}')
+
+        name = f'{METRIC_PREFIX}_cache_hit_ratio'
+        lines.append(f'# HELP {name} 快取命中率 (不需要自行讀取遠端的查詢比例)。')
+        lines.append(f'# TYPE {name} gauge')
+        for cache_name in sorted({cache_name for cache_name, _result in _cache_counts}):
+            total = sum(count for (name_, _result), count in _cache_counts.items() if name_ == cache_name)
+            served = sum(_cache_counts.get((cache_name, result), 0) for result in CACHE_SERVED_RESULTS)
+            lines.append(f'{name}{{{_format_labels({"cache": cache_name})}}} {served / total}')
+    return '\n'.join(lines) + '\n'
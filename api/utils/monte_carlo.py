@@ -0,0 +1,242 @@
+import os
+from .startup import lazy_module
+from .calculations import EPSILON, RISK_FREE_RATE, TRADING_DAYS_PER_YEAR
+from .parallel import run_partitioned, PARALLEL_MIN_CHUNKS
+
+np = lazy_module('numpy')
+
+# --- 蒙地卡羅模擬設定 ---
+# 以交易日數近似 get_rebalancing_dates 的日曆週期
+REBALANCE_INTERVALS = {'never': None, 'annually': 252, 'quarterly': 63, 'monthly': 21}
+DEFAULT_PERCENTILES = (5, 25, 50, 75, 95)
+METRIC_NAMES = ('cagr', 'mdd', 'volatility', 'sharpe_ratio', 'sortino_ratio', 'beta', 'alpha')
+# 每個區塊的記憶體上限 (各資產的累積成長與暫存陣列)，決定一次模擬多少條路徑
+CHUNK_MEMORY_BYTES = int(os.environ.get('MONTE_CARLO_CHUNK_MB', 64)) * 1024 * 1024
+# 每個亂數種子負責的路徑數。固定不變 (與記憶體上限無關)，同一個 seed 才能在任何設定下重現相同的路徑
+SEED_BLOCK_PATHS = 100
+# 淨值分位帶最多輸出的點數，避免保存每條路徑的每日淨值
+MAX_EQUITY_POINTS = 260
+
+
+def bootstrap_starts(rng, history_length, n_paths, n_days, block_size):
+    """
+    區塊拔靴法：每條路徑隨機抽取長度為 block_size 的連續歷史區段拼接成 n_days 天，
+    保留報酬的短期自我相關與資產間的同期相關。回傳 (n_paths, 區塊數) 的區段起點。
+    """
+    n_blocks = -(-n_days // block_size)
+    return rng.integers(0, history_length - block_size + 1, size=(n_paths, n_blocks))
+
+
+def draw_starts(seed_sequences, path_start, path_end, history_length, n_days, block_size):
+    """
+    第 path_start 到 path_end 條路徑 (不含 path_end) 的區段起點。
+    第 i 個種子固定產生第 i * SEED_BLOCK_PATHS 條起的 SEED_BLOCK_PATHS 條路徑，再切出所需的範圍，
+    因此任何一條路徑的抽樣只取決於 seed 與其編號，不受模擬時如何分組影響。
+    """
+    parts = []
+    for index in range(path_start // SEED_BLOCK_PATHS, -(-path_end // SEED_BLOCK_PATHS)):
+        block_start = index * SEED_BLOCK_PATHS
+        starts = bootstrap_starts(np.random.default_rng(seed_sequences[index]), history_length, SEED_BLOCK_PATHS, n_days, block_size)
+        parts.append(starts[max(path_start - block_start, 0):path_end - block_start])
+    return np.concatenate(parts)
+
+
+def cumulative_growth(history_cumulative, starts, block_indices, n_days):
+    """
+    回傳單一資產在各抽樣路徑上的累積成長 (路徑數, n_days + 1)，第 0 天為 1。
+    history_cumulative 為歷史累積成長 (第 0 天為 1)，區段內的累積成長即 H[起點 + k + 1] / H[起點]，
+    因此只需一次取值與一次乘法，不必對每條路徑重新累乘。
+    block_indices 為 starts[:, :, None] + (1..block_size)，同一區塊的所有資產共用。
+    """
+    n_paths, n_blocks, block_size = block_indices.shape
+    block_start_values = history_cumulative[starts]
+    block_growth = history_cumulative[starts + block_size] / block_start_values
+    # 每個區段開始前的累積成長 / 該區段起點的歷史值 = 區段內各天的縮放倍數
+    scale = np.empty((n_paths, n_blocks))
+    scale[:, 0] = 1.0
+    np.cumprod(block_growth[:, :-1], axis=1, out=scale[:, 1:])
+    scale /= block_start_values
+
+    cumulative = np.empty((n_paths, n_blocks * block_size + 1))
+    cumulative[:, 0] = 1.0
+    blocks = cumulative[:, 1:].reshape(n_paths, n_blocks, block_size)
+    np.multiply(history_cumulative[block_indices], scale[:, :, None], out=blocks)
+    return cumulative[:, :n_days + 1]
+
+
+def simulate_values(cumulatives, weights, rebalance_interval):
+    """
+    由各資產的累積成長計算投資組合淨值 (起始為 1)。
+    每個再平衡區段開始時依權重重新配置，區段內資產 a 的價值為 配置金額 x C_a[t] / C_a[區段起點]。
+    """
+    n_paths, length = cumulatives[0].shape
+    n_days = length - 1
+    values = np.empty((n_paths, length))
+    values[:, 0] = 1.0
+    interval = rebalance_interval or n_days
+    for segment_start in range(0, n_days, interval):
+        segment = slice(segment_start + 1, min(segment_start + interval, n_days) + 1)
+        segment_values = values[:, segment]
+        for i, (cumulative, weight) in enumerate(zip(cumulatives, weights)):
+            allocation = (values[:, segment_start] * weight / cumulative[:, segment_start])[:, None]
+            if i == 0:
+                np.multiply(cumulative[:, segment], allocation, out=segment_values)
+            else:
+                segment_values += cumulative[:, segment] * allocation
+    return values
+
+
+def path_returns(values, years):
+    """每條路徑的日報酬與其平均、變異數及 CAGR，基準只需計算一次即可供所有投資組合共用。"""
+    returns = values[:, 1:] / values[:, :-1]
+    returns -= 1
+    count = returns.shape[1]
+    mean = returns.mean(axis=1)
+    variance = (np.einsum('ij,ij->i', returns, returns) - count * mean**2) / (count - 1)
+    return {'returns': returns, 'mean': mean, 'variance': np.maximum(variance, 0),
+            'cagr': values[:, -1] ** (1 / years) - 1}
+
+
+def path_metrics(values, years, benchmark=None, risk_free_rate=RISK_FREE_RATE):
+    """
+    以向量化方式計算每條路徑的績效指標，定義與 calculate_metrics 一致。
+    benchmark 為 path_returns 的結果。回傳 {指標名稱: (路徑數,) 陣列}；無法計算的值為 NaN。
+    """
+    stats = path_returns(values, years)
+    returns, count, cagr = stats['returns'], stats['returns'].shape[1], stats['cagr']
+    peak = np.maximum.accumulate(values, axis=1)
+    mdd = np.divide(values, peak, out=peak).min(axis=1) - 1
+
+    annual_std = np.sqrt(stats['variance']) * np.sqrt(TRADING_DAYS_PER_YEAR)
+    excess_return = cagr - risk_free_rate
+    sharpe_ratio = excess_return / (annual_std + EPSILON)
+
+    beta = np.full(len(values), np.nan)
+    alpha = np.full(len(values), np.nan)
+    if benchmark is not None:
+        covariance = (np.einsum('ij,ij->i', returns, benchmark['returns']) - count * stats['mean'] * benchmark['mean']) / (count - 1)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            beta = np.where(benchmark['variance'] > EPSILON, covariance / benchmark['variance'], np.nan)
+        alpha = cagr - (risk_free_rate + beta * (benchmark['cagr'] - risk_free_rate))
+
+    # 下檔報酬直接覆寫日報酬陣列，避免再配置一份 (路徑數 x 天數) 的記憶體
+    daily_risk_free_rate = (1 + risk_free_rate)**(1/TRADING_DAYS_PER_YEAR) - 1
+    downside = np.minimum(returns - daily_risk_free_rate, 0, out=returns)
+    downside_std = np.sqrt(np.einsum('ij,ij->i', downside, downside) / count) * np.sqrt(TRADING_DAYS_PER_YEAR)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        sortino_ratio = np.where(downside_std > EPSILON, excess_return / downside_std, 0.0)
+
+    return {'cagr': cagr, 'mdd': mdd, 'volatility': annual_std, 'sharpe_ratio': sharpe_ratio,
+            'sortino_ratio': sortino_ratio, 'beta': beta, 'alpha': alpha}
+
+
+def simulate_chunks(returns, _dates, _columns, chunks, seed_sequences, portfolios, benchmark, n_days, block_size, equity_step):
+    """
+    模擬多個區塊的路徑。每個區塊 = (第一條路徑的編號, 結束編號)，抽樣由 draw_starts 依路徑編號決定，
+    因此結果不受區塊大小與分割方式影響。
+    所有投資組合在同一個區塊中共用相同的抽樣路徑 (共同隨機數)，比較時更穩定。
+    此函式也作為多核心模擬時子行程的工作函式，returns 為共享記憶體中的日報酬矩陣。
+    """
+    years = n_days / TRADING_DAYS_PER_YEAR
+    used_columns = sorted(set(column for portfolio in portfolios for column in portfolio['columns'])
+                          | (set(benchmark['columns']) if benchmark is not None else set()))
+    block_size = max(1, min(block_size, len(returns)))
+    # 每個資產的歷史累積成長 (第 0 天為 1)，所有區塊共用
+    history_cumulatives = {column: np.concatenate(([1.0], np.cumprod(returns[:, column] + 1))) for column in used_columns}
+
+    results = []
+    for path_start, path_end in chunks:
+        n_paths = path_end - path_start
+        starts = draw_starts(seed_sequences, path_start, path_end, len(returns), n_days, block_size)
+        block_indices = starts[:, :, None] + np.arange(1, block_size + 1)
+        cumulatives = {column: cumulative_growth(history_cumulatives[column], starts, block_indices, n_days) for column in used_columns}
+        block_indices = None
+
+        benchmark_stats = None
+        chunk_result = {'portfolios': []}
+        if benchmark is not None:
+            benchmark_values = simulate_values([cumulatives[column] for column in benchmark['columns']], benchmark['weights'], None)
+            benchmark_metrics = path_metrics(benchmark_values, years)
+            # 與回測相同，基準對自身的 Beta 為 1、Alpha 為 0
+            benchmark_metrics['beta'] = np.ones(n_paths)
+            benchmark_metrics['alpha'] = np.zeros(n_paths)
+            # 複製抽樣後的淨值，切片視圖會讓整個 (路徑數 x 天數) 陣列在區塊結束後仍無法釋放
+            chunk_result['benchmark'] = {'equity': np.ascontiguousarray(benchmark_values[:, ::equity_step]), 'metrics': benchmark_metrics}
+            benchmark_stats = path_returns(benchmark_values, years)
+        for portfolio in portfolios:
+            values = simulate_values([cumulatives[column] for column in portfolio['columns']], portfolio['weights'], portfolio['rebalance_interval'])
+            chunk_result['portfolios'].append({
+                'equity': np.ascontiguousarray(values[:, ::equity_step]),
+                'metrics': path_metrics(values, years, benchmark_stats),
+            })
+        results.append(chunk_result)
+    return results
+
+
+def _percentile_summary(samples, percentiles):
+    """各分位數的值；全部為 NaN 時回傳 None。"""
+    finite = samples[np.isfinite(samples)]
+    if finite.size == 0:
+        return {f'p{p}': None for p in percentiles}
+    return {f'p{p}': float(value) for p, value in zip(percentiles, np.percentile(finite, percentiles))}
+
+
+def _summarize(chunk_parts, initial_amount, equity_days, percentiles):
+    equity = np.concatenate([part['equity'] for part in chunk_parts]) * initial_amount
+    bands = np.percentile(equity, percentiles, axis=0)
+    return {
+        'equityBands': {'days': equity_days, **{f'p{p}': band.tolist() for p, band in zip(percentiles, bands)}},
+        'metrics': {
+            name: _percentile_summary(np.concatenate([part['metrics'][name] for part in chunk_parts]), percentiles)
+            for name in METRIC_NAMES
+        },
+    }
+
+
+def run_monte_carlo(returns_frame, portfolio_configs, initial_amount, n_paths, horizon_years, block_size, seed,
+                    benchmark_ticker=None, percentiles=DEFAULT_PERCENTILES):
+    """
+    以歷史日報酬矩陣 (列為交易日、欄為資產) 進行區塊拔靴模擬，回傳每個投資組合的淨值分位帶與指標分布。
+    路徑依記憶體上限切成多個區塊，區塊數量足夠時透過行程池平行計算；
+    固定 seed 可重現相同結果，與記憶體上限 (MONTE_CARLO_CHUNK_MB) 及行程池設定無關。
+    """
+    columns = list(returns_frame.columns)
+    n_days = int(round(horizon_years * TRADING_DAYS_PER_YEAR))
+
+    def allocation(tickers, weights):
+        """以欄位位置表示的資產配置，同一資產重複出現時權重相加。"""
+        combined = {}
+        for ticker, weight in zip(tickers, weights):
+            combined[columns.index(ticker)] = combined.get(columns.index(ticker), 0.0) + weight / 100.0
+        return {'columns': list(combined), 'weights': list(combined.values())}
+
+    portfolios = [
+        {**allocation(p_config['tickers'], p_config['weights']),
+         'rebalance_interval': REBALANCE_INTERVALS.get(p_config.get('rebalancingPeriod'))}
+        for p_config in portfolio_configs
+    ]
+    benchmark = allocation([benchmark_ticker], [100]) if benchmark_ticker else None
+
+    # 每條路徑需要每個資產一份累積成長 (天數)，外加抽樣索引、投資組合淨值與計算指標時的數份暫存陣列
+    bytes_per_path = n_days * 8 * (len(columns) + 6)
+    paths_per_chunk = max(1, min(n_paths, CHUNK_MEMORY_BYTES // bytes_per_path))
+    chunks = [(path_start, min(path_start + paths_per_chunk, n_paths)) for path_start in range(0, n_paths, paths_per_chunk)]
+    # 種子依固定的路徑數產生，區塊只決定一次模擬多少條路徑，不影響抽樣結果
+    seed_sequences = np.random.SeedSequence(seed).spawn(-(-n_paths // SEED_BLOCK_PATHS))
+
+    equity_step = max(1, -(-n_days // MAX_EQUITY_POINTS))
+    equity_days = list(range(0, n_days + 1, equity_step))
+
+    chunk_results = run_partitioned(
+        simulate_chunks, returns_frame, chunks, seed_sequences, portfolios, benchmark, n_days, block_size, equity_step,
+        min_items=PARALLEL_MIN_CHUNKS,
+    )
+
+    results = []
+    for i, p_config in enumerate(portfolio_configs):
+        summary = _summarize([chunk['portfolios'][i] for chunk in chunk_results], initial_amount, equity_days, percentiles)
+        results.append({'name': p_config['name'], **summary})
+    benchmark_result = None
+    if benchmark is not None:
+        benchmark_result = {'name': benchmark_ticker, **_summarize([chunk['benchmark'] for chunk in chunk_results], initial_amount, equity_days, percentiles)}
+    return results, benchmark_result
@@ -0,0 +1,160 @@
+import atexit
+import contextlib
+import multiprocessing
+import os
+import tempfile
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from multiprocessing import shared_memory
+from .startup import lazy_module
+
+np = lazy_module('numpy')
+
+# --- 多核心執行設定 ---
+# BACKTEST_POOL_SIZE: 行程池大小；'auto' 為 CPU 核心數。未設定或設為 1 即停用，
+#   與啟動模式 (APP_STARTUP_MODE) 無關：serverless 平台 (例如 Vercel) 不設定即維持單行程，
+#   長駐服務 (gunicorn 或 uvicorn) 在 Dockerfile 中啟用
+# PARALLEL_MIN_TICKERS / PARALLEL_MIN_PORTFOLIOS / PARALLEL_MIN_CHUNKS: 低於此數量時直接在目前行程中計算，避免行程間通訊的成本
+_pool_size_setting = os.environ.get('BACKTEST_POOL_SIZE') or '1'
+POOL_SIZE = (os.cpu_count() or 1) if _pool_size_setting == 'auto' else int(_pool_size_setting)
+PARALLEL_MIN_TICKERS = int(os.environ.get('PARALLEL_MIN_TICKERS', 500))
+PARALLEL_MIN_PORTFOLIOS = int(os.environ.get('PARALLEL_MIN_PORTFOLIOS', 8))
+PARALLEL_MIN_CHUNKS = int(os.environ.get('PARALLEL_MIN_CHUNKS', 2))
+# 每個 worker 分到的區塊數，讓執行較快的 worker 可以多拿幾塊
+CHUNKS_PER_WORKER = 4
+# 共享記憶體位於 /dev/shm (Docker 預設只有 64 MB)，寫入超過剩餘空間會觸發 SIGBUS 直接終止 worker。
+# 價格矩陣加上保留空間超過 /dev/shm 的剩餘空間時，改用暫存目錄中的記憶體映射檔案
+SHM_PATH = '/dev/shm'
+SHM_RESERVE_BYTES = int(os.environ.get('SHM_RESERVE_MB', 8)) * 1024 * 1024
+
+_pool = None
+_pool_lock = threading.Lock()
+
+
+def parallel_enabled():
+    return POOL_SIZE > 1
+
+
+def _get_pool():
+    """延遲建立全域行程池。使用 spawn 以避免在多執行緒的 gunicorn worker 中 fork。"""
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            _pool = ProcessPoolExecutor(max_workers=POOL_SIZE, mp_context=multiprocessing.get_context('spawn'))
+        return _pool
+
+
+def _reset_pool():
+    global _pool
+    with _pool_lock:
+        if _pool is not None:
+            _pool.shutdown(wait=False, cancel_futures=True)
+            _pool = None
+
+
+@atexit.register
+def _shutdown_pool():
+    if _pool is not None:
+        _pool.shutdown(wait=False, cancel_futures=True)
+
+
+def _split(items, chunk_count):
+    """將 items 依原順序切成 chunk_count 個連續區塊。"""
+    chunk_count = max(1, min(chunk_count, len(items)))
+    size, remainder = divmod(len(items), chunk_count)
+    chunks, start = [], 0
+    for i in range(chunk_count):
+        end = start + size + (1 if i < remainder else 0)
+        chunks.append(items[start:end])
+        start = end
+    return chunks
+
+
+def _shm_available(nbytes):
+    """/dev/shm 是否還有足夠空間放下 nbytes (加上保留空間)；無法查詢時 (非 Linux) 視為足夠。"""
+    try:
+        stats = os.statvfs(SHM_PATH)
+    except (OSError, AttributeError):
+        return True
+    return nbytes + SHM_RESERVE_BYTES <= stats.f_bavail * stats.f_frsize
+
+
+@contextlib.contextmanager
+def _shared_values(values):
+    """
+    將價格矩陣放到子行程可以附加的位置，回傳傳給 _run_chunk 的 handle；離開時釋放。
+    優先使用共享記憶體，/dev/shm 空間不足時改用暫存目錄中的記憶體映射檔案。
+    """
+    if _shm_available(values.nbytes):
+        shm = shared_memory.SharedMemory(create=True, size=max(values.nbytes, 1))
+        try:
+            np.ndarray(values.shape, dtype=np.float64, buffer=shm.buf)[:] = values
+            yield {'name': shm.name, 'shape': values.shape}
+        finally:
+            shm.close()
+            shm.unlink()
+        return
+
+    fd, path = tempfile.mkstemp(prefix='backtest-prices-', suffix='.dat')
+    os.close(fd)
+    try:
+        # 以一般檔案寫入：磁碟空間不足時拋出 OSError，而不是像寫入映射記憶體一樣觸發 SIGBUS
+        values.tofile(path)
+        yield {'path': path, 'shape': values.shape}
+    finally:
+        os.unlink(path)
+
+
+def _run_chunk(task, handle, chunk, args):
+    """在子行程中附加共享的價格矩陣並執行 task，不需要 pickle 整個 DataFrame。"""
+    if 'path' in handle:
+        # 記憶體映射檔案以 copy-on-write 開啟，task 即使修改陣列也不會寫回檔案
+        values = np.memmap(handle['path'], dtype=np.float64, mode='c', shape=handle['shape'])
+        return task(values, handle['dates'], handle['columns'], chunk, *args)
+
+    shm = shared_memory.SharedMemory(name=handle['name'])
+    try:
+        values = np.ndarray(handle['shape'], dtype=np.float64, buffer=shm.buf)
+        return task(values, handle['dates'], handle['columns'], chunk, *args)
+    finally:
+        values = None
+        try:
+            shm.close()
+        except BufferError:
+            # 仍有物件引用共享緩衝區時，交由垃圾回收釋放
+            pass
+
+
+def run_partitioned(task, price_frame, items, *args, min_items=PARALLEL_MIN_TICKERS):
+    """
+    將 items 分割後交給 task 計算，並依原順序合併結果。
+    task 的簽名為 task(values, dates, columns, items, *args) -> list，且必須是模組層級的函式。
+    items 數量低於 min_items 或未啟用多核心時，直接在目前行程中執行。
+    """
+    values = price_frame.to_numpy(dtype=np.float64)
+    dates = price_frame.index.values
+    columns = list(price_frame.columns)
+    if not parallel_enabled() or len(items) < min_items:
+        return task(values, dates, columns, items, *args)
+
+    values = np.ascontiguousarray(values)
+    with contextlib.ExitStack() as stack:
+        try:
+            handle = stack.enter_context(_shared_values(values))
+        except OSError as e:
+            print(f"警告：無法建立共享的價格矩陣，改為單行程計算: {e}")
+            return task(values, dates, columns, items, *args)
+        handle = {**handle, 'dates': dates, 'columns': columns}
+        chunks = _split(list(items), POOL_SIZE * CHUNKS_PER_WORKER)
+        try:
+            pool = _get_pool()
+            futures = [pool.submit(_run_chunk, task, handle, chunk, args) for chunk in chunks]
+            results = []
+            for future in futures:
+                results.extend(future.result())
+            return results
+        except BrokenProcessPool as e:
+            print(f"警告：行程池異常終止，改為單行程計算: {e}")
+            _reset_pool()
+            return task(values, dates, columns, items, *args)
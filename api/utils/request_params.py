@@ -0,0 +1,59 @@
+from .data_handler import get_price_ranges, load_adjustment_factors
+from .startup import lazy_module
+
+pd = lazy_module('pandas')
+
+
+class RequestError(ValueError):
+    """請求參數不正確；路由以 400 回傳其訊息。"""
+
+
+class PortfolioRequest:
+    """
+    /api/backtest、/api/walk-forward 與 /api/monte-carlo 共用的請求參數：
+    日期範圍、報酬基礎 (returnBasis)、投資組合與基準的股票代碼，以及調整因子的載入與缺漏提示。
+    參數不正確時拋出 RequestError。
+    """
+
+    def __init__(self, data):
+        self.data = data
+        self.start_date_str = f"{data['startYear']}-{data['startMonth']}-01"
+        self.start_date = pd.to_datetime(self.start_date_str)
+        self.end_date = pd.to_datetime(f"{data['endYear']}-{data['endMonth']}-01") + pd.offsets.MonthEnd(0)
+        self.end_date_str = self.end_date.strftime('%Y-%m-%d')
+
+        # returnBasis: 'total' (預設，含股息再投入) 或 'price' (只含價格變動)
+        self.return_basis = data.get('returnBasis', 'total')
+        if self.return_basis not in ('total', 'price'):
+            raise RequestError(f"不支援的報酬基礎: {self.return_basis}")
+
+        self.portfolio_configs = [p_config for p_config in data['portfolios'] if p_config['tickers']]
+        all_tickers = set(ticker for p in self.portfolio_configs for ticker in p['tickers'])
+        self.benchmark_ticker = data.get('benchmark')
+        if self.benchmark_ticker:
+            all_tickers.add(self.benchmark_ticker)
+        self.all_tickers = tuple(sorted(list(all_tickers)))
+        if not self.all_tickers:
+            raise RequestError('請至少在一個投資組合中設定一項資產。')
+
+        self.initial_amount = float(data['initialAmount'])
+        self.missing_factor_tickers = set()
+
+    def load_price_ranges(self, require_all=False):
+        """所有股票的有效日期範圍 (見 get_price_ranges)；require_all 時任何一支股票沒有數據即為錯誤。"""
+        price_ranges = get_price_ranges(self.all_tickers)
+        missing_tickers = [ticker for ticker in self.all_tickers if ticker not in price_ranges]
+        if require_all and missing_tickers:
+            raise RequestError(f"找不到以下股票的數據: {', '.join(missing_tickers)}")
+        return price_ranges
+
+    def adjustment_factors(self, price_frame):
+        """price_frame 轉換為所選報酬基礎的調整因子 ('total' 時為 None)，並記錄缺少因子資料的股票。"""
+        factors, missing_tickers = load_adjustment_factors(price_frame.columns, price_frame.index, self.return_basis)
+        self.missing_factor_tickers.update(missing_tickers)
+        return factors
+
+    def factor_warning(self):
+        if not self.missing_factor_tickers:
+            return None
+        return f"部分資產缺少股息調整資料，仍以含息總報酬計算：{', '.join(sorted(self.missing_factor_tickers))}"
@@ -1,6 +1,9 @@
-import numpy as np
-import pandas as pd
+from .startup import lazy_module
 from .calculations import calculate_metrics, EPSILON
+from .instrumentation import span
+
+np = lazy_module('numpy')
+pd = lazy_module('pandas')
 
 def get_rebalancing_dates(df_prices, period):
     if period == 'never': return []
@@ -18,36 +21,67 @@ def get_rebalancing_dates(df_prices, period):
         return []
     return rebalance_dates[1:] if len(rebalance_dates) > 1 else []
 
-def run_simulation(portfolio_config, price_data, initial_amount, benchmark_history=None):
+def rebalancing_positions(df_prices, period):
+    """再平衡日在 df_prices 中的列位置 (遞增，不含第一個交易日)。"""
+    positions = np.flatnonzero(df_prices.index.isin(get_rebalancing_dates(df_prices, period)))
+    return positions[positions > 0]
+
+def simulate_values(prices, weights, rebalance_positions, initial_amount):
+    """
+    以價格矩陣 (天數 x 資產數) 模擬投資組合淨值，回傳每日淨值的 NumPy 陣列。
+    持股只在再平衡日改變，兩個再平衡日之間的淨值以一次矩陣運算求出，
+    結果與逐日更新持股的迴圈完全相同 (缺值的價格不計入當日淨值)。
+    """
+    # 以列連續的陣列逐列加總，加總順序才會與逐日迴圈中單列的加總相同
+    prices = np.ascontiguousarray(prices, dtype=float)
+    values = np.empty(len(prices))
+    values[0] = initial_amount
+    shares = (initial_amount * weights) / (prices[0] + EPSILON)
+    start = 0
+    for end in list(rebalance_positions) + [len(prices) - 1]:
+        if end <= start:
+            continue
+        values[start + 1:end + 1] = np.nansum(prices[start + 1:end + 1] * shares, axis=1)
+        # 再平衡日以當日淨值重新依權重買入
+        shares = (values[end] * weights) / (prices[end] + EPSILON)
+        start = end
+    return values
+
+def run_simulation(portfolio_config, price_data, initial_amount, benchmark_history=None, adjustment_factors=None):
+    """
+    模擬單一投資組合的淨值走勢並計算績效指標。
+    benchmark_history 可以是基準淨值的 DataFrame，或 prepare_benchmark 預先計算好的結果。
+    adjustment_factors 為 load_adjustment_factors 回傳的累積調整因子 (與 price_data 對齊)，
+    提供時會以一次向量化乘法將總報酬價格轉換為選定的報酬基礎；None 代表直接使用總報酬。
+    """
     tickers = portfolio_config['tickers']
     weights = np.array(portfolio_config['weights']) / 100.0
     rebalancing_period = portfolio_config['rebalancingPeriod']
-    df_prices = price_data[tickers].copy()
+    if adjustment_factors is None:
+        df_prices = price_data[tickers].copy()
+    else:
+        df_prices = price_data[tickers] * adjustment_factors[tickers]
     if df_prices.empty: return None
     
-    portfolio_history = pd.Series(index=df_prices.index, dtype=float, name="value")
-    rebalancing_dates = get_rebalancing_dates(df_prices, rebalancing_period)
-    
-    current_date = df_prices.index[0]
-    initial_prices = df_prices.loc[current_date]
-    shares = (initial_amount * weights) / (initial_prices + EPSILON)
-    portfolio_history.loc[current_date] = initial_amount
-    
-    for i in range(1, len(df_prices)):
-        current_date = df_prices.index[i]
-        current_prices = df_prices.loc[current_date]
-        
-        current_value = (shares * current_prices).sum()
-        portfolio_history.loc[current_date] = current_value
-        
-        if current_date in rebalancing_dates:
-            shares = (current_value * weights) / (current_prices + EPSILON)
-            
-    portfolio_history.dropna(inplace=True)
-    metrics = calculate_metrics(portfolio_history.to_frame('value'), benchmark_history)
+    with span('simulation'):
+        rebalance_positions = rebalancing_positions(df_prices, rebalancing_period)
+        values = simulate_values(df_prices.to_numpy(), weights, rebalance_positions, initial_amount)
+        portfolio_history = pd.Series(values, index=df_prices.index, name="value")
+        portfolio_history.dropna(inplace=True)
+
+    with span('metrics'):
+        metrics = calculate_metrics(portfolio_history.to_frame('value'), benchmark_history)
     
     return {
         'name': portfolio_config['name'], 
         **metrics, 
         'portfolioHistory': [{'date': date.strftime('%Y-%m-%d'), 'value': value} for date, value in portfolio_history.items()]
     }
+
+def simulate_portfolios(values, dates, columns, portfolio_configs, initial_amount, benchmark_history=None, adjustment_factors=None):
+    """
+    依序模擬多個投資組合，回傳與 portfolio_configs 相同順序的結果列表。
+    此函式也作為多核心回測時子行程的工作函式，價格矩陣以 NumPy 陣列傳入，不複製數據。
+    """
+    price_data = pd.DataFrame(values, index=pd.DatetimeIndex(dates), columns=columns, copy=False)
+    return [run_simulation(p_config, price_data, initial_amount, benchmark_history, adjustment_factors) for p_config in portfolio_configs]
@@ -0,0 +1,170 @@
+import os
+import threading
+import time
+from collections import OrderedDict
+
+# --- 快取時效設定 (秒) ---
+# DATA_CACHE_TTL    : 數據被視為最新的時間
+# DATA_CACHE_STALE  : 過期後仍可先回傳舊值、同時在背景更新的時間
+# DATA_CACHE_NEGATIVE_TTL: 讀取失敗的結果只快取很短的時間，避免失敗被保留 30 分鐘，也避免連續重試打爆遠端
+DATA_CACHE_TTL = int(os.environ.get('DATA_CACHE_TTL', 1800))
+DATA_CACHE_STALE = int(os.environ.get('DATA_CACHE_STALE', 1800))
+DATA_CACHE_NEGATIVE_TTL = int(os.environ.get('DATA_CACHE_NEGATIVE_TTL', 30))
+# DATA_CACHE_WAIT_TIMEOUT: 等待其他執行緒載入的上限；超過此時間仍未完成的載入視為已卡住，
+# 等待者收到 TimeoutError，下一個請求會重新開始載入，不會讓一個卡住的讀取永久阻塞該鍵
+DATA_CACHE_WAIT_TIMEOUT = float(os.environ.get('DATA_CACHE_WAIT_TIMEOUT', 60))
+
+
+class _Entry:
+    __slots__ = ('value', 'error', 'fresh_until', 'stale_until', 'retry_at')
+
+    def __init__(self, value, error, fresh_until, stale_until):
+        self.value = value
+        self.error = error
+        self.fresh_until = fresh_until
+        self.stale_until = stale_until
+        self.retry_at = 0.0
+
+
+class _Flight:
+    """一次進行中的載入；其他請求相同鍵的執行緒等待它完成並共用結果。"""
+    __slots__ = ('done', 'value', 'error', 'started')
+
+    def __init__(self, started):
+        self.started = started
+        self.done = threading.Event()
+        self.value = None
+        self.error = None
+
+
+class SingleFlightCache:
+    """
+    執行緒安全的 LRU + TTL 快取，同一個鍵同時只會有一個載入程序 (single-flight)。
+    - 快取未命中時，第一個執行緒負責載入，其他執行緒等待其結果，不會同時打到遠端。
+    - 過期但仍在 stale 期間的值會立即回傳，並在背景執行緒中更新。
+    - 載入失敗 (拋出例外) 只快取 negative_ttl 秒，期間內的請求直接收到相同的例外。
+    - 等待其他執行緒的載入最多 wait_timeout 秒；超過時間仍未完成的載入會被新的載入取代。
+    """
+
+    def __init__(self, maxsize, ttl=DATA_CACHE_TTL, stale_ttl=DATA_CACHE_STALE, negative_ttl=DATA_CACHE_NEGATIVE_TTL,
+                 wait_timeout=DATA_CACHE_WAIT_TIMEOUT, timer=time.monotonic):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.stale_ttl = stale_ttl
+        self.negative_ttl = negative_ttl
+        self.wait_timeout = wait_timeout
+        self._timer = timer
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()
+        self._flights = {}
+        # clear() 之後，先前開始的載入結果不再寫回快取
+        self._generation = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._generation += 1
+
+    def _active_flight(self, key, now):
+        """進行中且尚未逾時的載入；逾時的載入視為已卡住 (須在持有鎖時呼叫)。"""
+        flight = self._flights.get(key)
+        if flight is not None and now - flight.started >= self.wait_timeout:
+            return None
+        return flight
+
+    def contains(self, key):
+        """是否有可直接回傳的值 (新鮮或 stale 期間內，且不是失敗結果)。"""
+        with self._lock:
+            entry = self._entries.get(key)
+            return entry is not None and entry.error is None and self._timer() < entry.stale_until
+
+    def set(self, key, value):
+        """直接寫入一個新鮮的值 (例如由非同步預先載入取得的數據)。"""
+        now = self._timer()
+        with self._lock:
+            self._entries[key] = _Entry(value, None, now + self.ttl, now + self.ttl + self.stale_ttl)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    def peek(self, key, loader):
+        """
+        不阻塞的查詢，回傳 (是否命中, 值, 'hit' | 'stale')。
+        命中 stale 值時，若沒有進行中的載入且不在重試冷卻期，會以 loader 在背景更新。
+        快取的是失敗結果時直接拋出該例外。
+        """
+        now = self._timer()
+        refresh = None
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return False, None, None
+            if now < entry.fresh_until:
+                self._entries.move_to_end(key)
+                if entry.error is not None:
+                    raise entry.error
+                return True, entry.value, 'hit'
+            if entry.error is not None or now >= entry.stale_until:
+                return False, None, None
+            self._entries.move_to_end(key)
+            if self._active_flight(key, now) is None and now >= entry.retry_at:
+                refresh = self._flights[key] = _Flight(now)
+                generation = self._generation
+        if refresh is not None:
+            threading.Thread(target=self._load, args=(key, loader, refresh, generation, True), daemon=True).start()
+        return True, entry.value, 'stale'
+
+    def load(self, key, loader):
+        """
+        阻塞式載入，回傳 (值, 'hit' | 'miss' | 'coalesced')。
+        已有其他執行緒在載入相同的鍵時等待其結果 (最多 wait_timeout 秒，逾時拋出 TimeoutError)；
+        載入失敗時拋出例外。
+        """
+        with self._lock:
+            now = self._timer()
+            entry = self._entries.get(key)
+            if entry is not None and now < entry.fresh_until:
+                if entry.error is not None:
+                    raise entry.error
+                return entry.value, 'hit'
+            flight = self._active_flight(key, now)
+            leader = flight is None
+            if leader:
+                flight = self._flights[key] = _Flight(now)
+                generation = self._generation
+
+        if leader:
+            self._load(key, loader, flight, generation)
+        elif not flight.done.wait(self.wait_timeout):
+            raise TimeoutError(f"等待載入 {key!r} 超過 {self.wait_timeout} 秒")
+        if flight.error is not None:
+            raise flight.error
+        return flight.value, 'miss' if leader else 'coalesced'
+
+    def _load(self, key, loader, flight, generation, background=False):
+        try:
+            flight.value = loader()
+        except Exception as e:
+            flight.error = e
+        now = self._timer()
+        with self._lock:
+            # 已被取代 (逾時) 的載入不寫回快取，避免以較舊的結果覆蓋新的載入
+            current = self._flights.get(key) is flight
+            if current and generation == self._generation:
+                stale_entry = self._entries.get(key)
+                if flight.error is None:
+                    self._entries[key] = _Entry(flight.value, None, now + self.ttl, now + self.ttl + self.stale_ttl)
+                elif background and stale_entry is not None and stale_entry.error is None:
+                    # 背景更新失敗：繼續提供舊值，negative_ttl 之後再重試
+                    stale_entry.retry_at = now + self.negative_ttl
+                else:
+                    self._entries[key] = _Entry(None, flight.error, now + self.negative_ttl, now + self.negative_ttl)
+                self._entries.move_to_end(key)
+                while len(self._entries) > self.maxsize:
+                    self._entries.popitem(last=False)
+            if current:
+                del self._flights[key]
+        flight.done.set()
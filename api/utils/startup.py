@@ -0,0 +1,93 @@
+import importlib
+import os
+import sys
+import time
+import types
+
+# --- 啟動模式設定 ---
+# 'serverless': 延遲匯入重型套件與遠端數據，直到第一次真正使用時才載入 (適合 Vercel 冷啟動)
+# 'preload'   : 在 gunicorn master 中預先匯入並暖機快取，fork 後各 worker 以 copy-on-write 共享記憶體
+# 未設定時為 serverless：匯入 api.index (本機開發、腳本、uvicorn worker) 不會有任何網路讀取等副作用；
+# 長駐的 gunicorn 部署須明確設定 APP_STARTUP_MODE=preload (見 Dockerfile)
+STARTUP_MODE = os.environ.get('APP_STARTUP_MODE') or 'serverless'
+
+# preload 模式下預先載入價格的股票 (以逗號分隔)，預設為前端的預設比較基準
+WARMUP_TICKERS = [ticker for ticker in os.environ.get('WARMUP_TICKERS', 'SPY').split(',') if ticker]
+
+# 記錄各階段耗時 (毫秒)，用於追蹤冷啟動的效能退化
+STARTUP_TIMINGS = {}
+
+# 所有透過 lazy_module 建立的延遲模組
+_lazy_modules = {}
+
+
+def record_timing(name, start_time):
+    """記錄從 start_time (time.perf_counter) 到現在的耗時，單位為毫秒。"""
+    elapsed_ms = round((time.perf_counter() - start_time) * 1000, 2)
+    STARTUP_TIMINGS[name] = elapsed_ms
+    return elapsed_ms
+
+
+class _LazyModule(types.ModuleType):
+    """第一次存取屬性時才真正匯入的模組代理。"""
+
+    def __getattr__(self, attr):
+        module = _load_lazy_module(self)
+        return getattr(module, attr)
+
+
+def _load_lazy_module(proxy):
+    name = proxy.__name__
+    start_time = time.perf_counter()
+    module = importlib.import_module(name)
+    if f'import:{name}' not in STARTUP_TIMINGS:
+        record_timing(f'import:{name}', start_time)
+    # 將真實模組的屬性複製到代理上，之後的屬性存取就不再經過 __getattr__，沒有額外成本
+    proxy.__dict__.update(module.__dict__)
+    return module
+
+
+def lazy_module(name):
+    """
+    回傳一個延遲匯入的模組。
+    若模組已被匯入 (例如 preload 模式)，直接回傳真實模組。
+    """
+    if name in sys.modules:
+        return sys.modules[name]
+    if name not in _lazy_modules:
+        _lazy_modules[name] = _LazyModule(name)
+    return _lazy_modules[name]
+
+
+def preload_modules():
+    """立即匯入所有延遲模組 (preload 模式於 fork 前呼叫)。"""
+    start_time = time.perf_counter()
+    for proxy in list(_lazy_modules.values()):
+        if '__file__' not in proxy.__dict__:
+            _load_lazy_module(proxy)
+    record_timing('preload_modules', start_time)
+
+
+def warm_up():
+    """
+    預先匯入重型套件並暖機數據快取。
+    任何暖機失敗都只記錄日誌，不影響服務啟動。
+    """
+    preload_modules()
+
+    # 在函式內匯入以避免與 data_handler 的循環匯入
+    from .data_handler import get_preprocessed_data, load_ticker_prices
+
+    start_time = time.perf_counter()
+    try:
+        stock_count = len(get_preprocessed_data())
+        print(f"--- 暖機完成：已快取 {stock_count} 筆預處理數據 ---")
+    except Exception as e:
+        print(f"警告：暖機預處理數據失敗: {e}")
+    record_timing('warm_preprocessed_data', start_time)
+
+    start_time = time.perf_counter()
+    loaded = [ticker for ticker in WARMUP_TICKERS if load_ticker_prices(ticker) is not None]
+    if WARMUP_TICKERS:
+        print(f"--- 暖機完成：已快取 {len(loaded)}/{len(WARMUP_TICKERS)} 支股票的價格 ---")
+    record_timing('warm_prices', start_time)
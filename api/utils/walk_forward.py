@@ -0,0 +1,129 @@
+from .startup import lazy_module
+from .calculations import calculate_metrics_from_arrays, prepare_benchmark, years_between
+from .simulation import rebalancing_positions, simulate_values
+
+np = lazy_module('numpy')
+pd = lazy_module('pandas')
+
+# --- 滾動起點 (walk-forward) 回測設定 ---
+# 區間起點在數據中找不到 BDAY_TOLERANCE 個營業日內的交易日時 (資產尚未上市)，略過該區間，
+# 與 find_late_starts 判斷起始日過晚的門檻相同
+BDAY_TOLERANCE = 5
+SUMMARY_METRICS = ('cagr', 'mdd', 'volatility', 'sharpe_ratio', 'sortino_ratio')
+
+
+def build_windows(dates, range_start, range_end, step_months, window_years=None):
+    """
+    在 [range_start, range_end] 內每隔 step_months 個月產生一個區間起點。
+    window_years 為 None 時每個區間都延伸到 range_end (滾動起點)；否則為固定長度的區間，
+    超出 range_end 的區間不列入。回傳 ([(起始列位置, 結束列位置), ...], 因數據不足略過的區間數)。
+    """
+    windows, skipped = [], 0
+    step = 0
+    while True:
+        start = range_start + pd.DateOffset(months=step * step_months)
+        step += 1
+        if start > range_end:
+            break
+        end = range_end if window_years is None else start + pd.DateOffset(years=window_years) - pd.Timedelta(days=1)
+        if end > range_end:
+            break
+        start_position = int(np.searchsorted(dates, np.datetime64(start), side='left'))
+        end_position = int(np.searchsorted(dates, np.datetime64(end), side='right')) - 1
+        if start_position >= len(dates) or end_position - start_position < 1 \
+                or pd.Timestamp(dates[start_position]) > start + pd.offsets.BDay(BDAY_TOLERANCE):
+            skipped += 1
+            continue
+        windows.append((start_position, end_position))
+    return windows, skipped
+
+
+def window_values(full_values, prices, weights, rebalance_positions, start, end, initial_amount):
+    """
+    區間 [start, end] (列位置，含兩端) 從 start 以 initial_amount 重新買入的每日淨值，
+    結果與對該區間單獨執行 run_simulation 相同 (僅有浮點捨入誤差)。
+    - start 是共用路徑的再平衡日 (或第一天)：兩者在 start 都依權重買入，直接縮放共用路徑。
+    - 否則只重新模擬 start 到下一個再平衡日這一小段；該日兩者都依權重重新買入，之後同樣縮放共用路徑。
+    - 不再平衡的多資產組合沒有共同的再平衡日，整段重新模擬 (向量化，成本與區間長度成正比)。
+    """
+    next_index = int(np.searchsorted(rebalance_positions, start, side='left'))
+    if start == 0 or (next_index < len(rebalance_positions) and rebalance_positions[next_index] == start):
+        return full_values[start:end + 1] * (initial_amount / full_values[start])
+
+    head_end = end if next_index == len(rebalance_positions) else min(int(rebalance_positions[next_index]), end)
+    head = simulate_values(prices[start:head_end + 1], weights, [], initial_amount)
+    if head_end == end:
+        return head
+    tail = full_values[head_end + 1:end + 1] * (head[-1] / full_values[head_end])
+    return np.concatenate((head, tail))
+
+
+def _history(dates, values):
+    return [{'date': date.strftime('%Y-%m-%d'), 'value': float(value)} for date, value in zip(pd.DatetimeIndex(dates), values)]
+
+
+def summarize_windows(rows):
+    """各區間績效指標的最小值、中位數與最大值，以及 CAGR 為正的區間比例。"""
+    summary = {}
+    for metric in SUMMARY_METRICS:
+        values = np.array([row[metric] for row in rows], dtype=float)
+        summary[metric] = {'min': float(values.min()), 'median': float(np.median(values)), 'max': float(values.max())}
+    summary['positiveRatio'] = float(np.mean([row['cagr'] > 0 for row in rows]))
+    return summary
+
+
+def run_walk_forward(price_data, portfolio_configs, initial_amount, windows, benchmark_ticker=None,
+                     adjustment_factors=None, include_history=False):
+    """
+    對多個區間回測同一組投資組合。每個投資組合只在完整的對齊價格上模擬一次，
+    各區間的淨值由共用路徑縮放 (見 window_values)，再以 calculate_metrics 的核心計算指標。
+    price_data 為所有資產 (含基準) 的共同交易日價格，windows 為 build_windows 的結果。
+    回傳 (各投資組合的結果, 基準的結果)，每個結果含與 windows 同順序的 windows 列表與 summary。
+    """
+    if adjustment_factors is not None:
+        price_data = price_data * adjustment_factors[price_data.columns]
+    dates = price_data.index.values
+
+    shared_paths = []
+    for p_config in portfolio_configs:
+        frame = price_data[p_config['tickers']]
+        prices = np.ascontiguousarray(frame.to_numpy(dtype=float))
+        weights = np.array(p_config['weights']) / 100.0
+        positions = rebalancing_positions(frame, p_config['rebalancingPeriod'])
+        shared_paths.append((prices, weights, positions, simulate_values(prices, weights, positions, initial_amount)))
+
+    benchmark_prices = None
+    if benchmark_ticker and benchmark_ticker in price_data.columns:
+        benchmark_prices = np.ascontiguousarray(price_data[[benchmark_ticker]].to_numpy(dtype=float))
+
+    portfolio_rows = [[] for _ in portfolio_configs]
+    benchmark_rows = []
+    for start, end in windows:
+        window_dates = dates[start:end + 1]
+        years = years_between(window_dates[0], window_dates[-1])
+        period = {'startDate': pd.Timestamp(window_dates[0]).strftime('%Y-%m-%d'), 'endDate': pd.Timestamp(window_dates[-1]).strftime('%Y-%m-%d')}
+
+        # 基準為單一資產、不再平衡，與 /api/backtest 相同地在區間內重新模擬
+        benchmark = None
+        if benchmark_prices is not None:
+            benchmark_values = simulate_values(benchmark_prices[start:end + 1], np.array([1.0]), [], initial_amount)
+            benchmark = prepare_benchmark(pd.DataFrame({'value': benchmark_values}, index=pd.DatetimeIndex(window_dates)))
+            row = {**period, 'finalValue': float(benchmark_values[-1]),
+                   **calculate_metrics_from_arrays(benchmark_values, window_dates, years), 'beta': 1.0, 'alpha': 0.0}
+            if include_history:
+                row['portfolioHistory'] = _history(window_dates, benchmark_values)
+            benchmark_rows.append(row)
+
+        for rows, (prices, weights, positions, full_values) in zip(portfolio_rows, shared_paths):
+            values = window_values(full_values, prices, weights, positions, start, end, initial_amount)
+            row = {**period, 'finalValue': float(values[-1]), **calculate_metrics_from_arrays(values, window_dates, years, benchmark)}
+            if include_history:
+                row['portfolioHistory'] = _history(window_dates, values)
+            rows.append(row)
+
+    results = [{'name': p_config['name'], 'windows': rows, 'summary': summarize_windows(rows)}
+               for p_config, rows in zip(portfolio_configs, portfolio_rows)]
+    benchmark_result = None
+    if benchmark_rows:
+        benchmark_result = {'name': benchmark_ticker, 'windows': benchmark_rows, 'summary': summarize_windows(benchmark_rows)}
+    return results, benchmark_result
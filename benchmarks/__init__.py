@@ -0,0 +1 @@
+# 這個檔案讓 benchmarks 成為可匯入的套件，以便使用 python -m benchmarks.run_benchmarks 執行。
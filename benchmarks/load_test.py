@@ -0,0 +1,184 @@
+# load_test.py: 比較 WSGI (gunicorn) 與 ASGI (uvicorn + api.asgi) 兩種服務模式在數據 I/O 等待下的吞吐量
+#
+# 在本機啟動一個模擬 GitHub raw 的數據伺服器 (每次讀取加上人為延遲)，以 DATA_BASE_URL 指向它，
+# 再分別以子行程啟動兩種服務模式，並行送出冷快取的回測請求 (每個請求使用不同的股票)，
+# 回報每秒請求數與延遲分位數。需要 gunicorn、uvicorn 與 httpx。在專案根目錄執行：
+#   python -m benchmarks.load_test --requests 200 --concurrency 50 --latency-ms 200
+#   python -m benchmarks.load_test --modes asgi --workers 2
+
+import argparse
+import io
+import json
+import os
+import socket
+import statistics
+import subprocess
+import sys
+import threading
+import time
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import numpy as np
+import pandas as pd
+import requests
+
+BENCHMARK_TICKER = 'SPY'
+END_DATE = '2024-12-31'
+PROJECT_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+# --- 模擬的數據伺服器 ---
+def ticker_csv(ticker, n_years):
+    """以股票代碼為種子產生可重現的價格 CSV，欄位與 data 分支的價格檔相同。"""
+    rng = np.random.default_rng(zlib.crc32(ticker.encode('utf-8')))
+    dates = pd.bdate_range(end=END_DATE, periods=int(n_years * 252))
+    close = 100 * np.exp(np.cumsum(rng.normal(0.0003, 0.015, len(dates))))
+    buffer = io.StringIO()
+    pd.DataFrame({'Close': close, 'PriceFactor': 1.0}, index=pd.Index(dates, name='Date')).to_csv(buffer)
+    return buffer.getvalue().encode('utf-8')
+
+
+def start_data_server(latency_ms, n_years, tickers):
+    """
+    啟動背景執行緒中的數據伺服器，回傳 (server, base_url)。
+    價格檔事先產生，避免產生 CSV 的時間計入負載測試；每個請求先等待 latency_ms 再回應。
+    """
+    files = {f'/prices/{ticker}.csv': ticker_csv(ticker, n_years) for ticker in tickers}
+    files['/version.json'] = json.dumps({'version': 'load-test'}).encode('utf-8')
+    files['/preprocessed_data.json'] = json.dumps([{'ticker': ticker, 'sector': 'Technology', 'in_sp500': True} for ticker in tickers]).encode('utf-8')
+
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            time.sleep(latency_ms / 1000)
+            content = files.get(self.path)
+            if content is None:
+                self.send_error(404)
+                return
+            self.send_response(200)
+            self.send_header('Content-Length', str(len(content)))
+            self.end_headers()
+            self.wfile.write(content)
+
+        def log_message(self, *args):
+            pass
+
+    server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, f'http://127.0.0.1:{server.server_address[1]}'
+
+
+# --- 服務模式 ---
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def server_command(mode, port, workers):
+    if mode == 'wsgi':
+        # 與 Dockerfile 相同的同步 worker：每個 worker 同時只處理一個請求
+        return [sys.executable, '-m', 'gunicorn', '--workers', str(workers), '--bind', f'127.0.0.1:{port}', 'api.index:app']
+    return [sys.executable, '-m', 'uvicorn', 'api.asgi:app', '--workers', str(workers), '--host', '127.0.0.1',
+            '--port', str(port), '--log-level', 'warning']
+
+
+def start_app_server(mode, workers, data_base_url):
+    port = free_port()
+    env = {**os.environ, 'DATA_BASE_URL': data_base_url, 'APP_STARTUP_MODE': 'serverless'}
+    process = subprocess.Popen(server_command(mode, port, workers), cwd=PROJECT_ROOT, env=env,
+                               stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    base_url = f'http://127.0.0.1:{port}'
+    deadline = time.time() + 60
+    while time.time() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError(f'{mode} 服務啟動失敗 (結束代碼 {process.returncode})')
+        try:
+            requests.get(f'{base_url}/api/health', timeout=1)
+            return process, base_url
+        except requests.RequestException:
+            time.sleep(0.2)
+    process.terminate()
+    raise RuntimeError(f'{mode} 服務在 60 秒內沒有回應')
+
+
+# --- 負載 ---
+def backtest_payload(index, tickers_per_request, window_years):
+    """
+    每個請求使用不同的股票，讓每個請求都需要讀取遠端數據 (冷快取)。
+    回測區間預設很短，讓結果反映數據 I/O 的等待，而不是模擬本身的 CPU 時間。
+    """
+    end_year = int(END_DATE[:4])
+    tickers = [f'L{index:05d}{j}' for j in range(tickers_per_request)]
+    return {
+        'initialAmount': 10000, 'benchmark': BENCHMARK_TICKER,
+        'startYear': end_year - window_years + 1, 'startMonth': 1, 'endYear': end_year, 'endMonth': 12,
+        'portfolios': [{'name': f'load-{index}', 'tickers': tickers, 'weights': [100 / len(tickers)] * len(tickers),
+                        'rebalancingPeriod': 'quarterly'}],
+    }
+
+
+def run_load(base_url, n_requests, concurrency, tickers_per_request, window_years):
+    """並行送出 n_requests 個回測請求，回傳吞吐量與延遲統計。"""
+    session = requests.Session()
+    session.mount('http://', requests.adapters.HTTPAdapter(pool_connections=concurrency, pool_maxsize=concurrency))
+
+    def send(index):
+        start_time = time.perf_counter()
+        response = session.post(f'{base_url}/api/backtest', json=backtest_payload(index, tickers_per_request, window_years), timeout=300)
+        return time.perf_counter() - start_time, response.status_code
+
+    start_time = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        results = list(executor.map(send, range(n_requests)))
+    elapsed = time.perf_counter() - start_time
+
+    latencies = sorted(latency for latency, _ in results)
+    return {
+        'requests': n_requests, 'errors': sum(1 for _, status in results if status != 200),
+        'seconds': elapsed, 'throughput': n_requests / elapsed,
+        'p50': statistics.median(latencies), 'p95': latencies[min(len(latencies) - 1, int(0.95 * len(latencies)))],
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='WSGI 與 ASGI 服務模式在數據 I/O 等待下的負載測試')
+    parser.add_argument('--modes', nargs='*', default=['wsgi', 'asgi'], choices=['wsgi', 'asgi'])
+    parser.add_argument('--workers', type=int, default=4, help='每種模式的 worker 行程數 (Dockerfile 預設為 4)')
+    parser.add_argument('--requests', type=int, default=200, help='總請求數')
+    parser.add_argument('--concurrency', type=int, default=50, help='同時進行的請求數')
+    parser.add_argument('--tickers-per-request', type=int, default=3)
+    parser.add_argument('--years', type=int, default=10, help='模擬價格檔的歷史年數')
+    parser.add_argument('--window-years', type=int, default=1, help='回測區間的年數')
+    parser.add_argument('--latency-ms', type=float, default=200.0, help='數據伺服器每次讀取的延遲')
+    args = parser.parse_args(argv)
+
+    tickers = [ticker for index in range(args.requests)
+               for ticker in backtest_payload(index, args.tickers_per_request, args.window_years)['portfolios'][0]['tickers']]
+    data_server, data_base_url = start_data_server(args.latency_ms, args.years, tickers + [BENCHMARK_TICKER])
+    print(f"數據伺服器: {data_base_url} (延遲 {args.latency_ms:.0f} ms)")
+
+    summaries = {}
+    try:
+        for mode in args.modes:
+            process, base_url = start_app_server(mode, args.workers, data_base_url)
+            try:
+                summaries[mode] = run_load(base_url, args.requests, args.concurrency, args.tickers_per_request, args.window_years)
+            finally:
+                process.terminate()
+                process.wait(timeout=30)
+    finally:
+        data_server.shutdown()
+
+    print(f"\n{'模式':<8}{'請求/秒':>10}{'p50 (ms)':>12}{'p95 (ms)':>12}{'錯誤':>8}")
+    for mode, summary in summaries.items():
+        print(f"{mode:<8}{summary['throughput']:>10.1f}{summary['p50'] * 1000:>12.0f}{summary['p95'] * 1000:>12.0f}{summary['errors']:>8}")
+    if {'wsgi', 'asgi'} <= summaries.keys():
+        print(f"\nASGI / WSGI 吞吐量比: {summaries['asgi']['throughput'] / summaries['wsgi']['throughput']:.2f}x")
+    return summaries
+
+
+if __name__ == '__main__':
+    main()
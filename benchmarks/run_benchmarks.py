@@ -0,0 +1,244 @@
+# run_benchmarks.py: 回測、滾動起點回測、掃描、篩選器與蒙地卡羅模擬熱路徑的可重現效能基準測試
+#
+# 完全離線執行：以合成的價格宇宙取代 load_ticker_history 與 get_preprocessed_data。
+# 在專案根目錄執行：
+#   python -m benchmarks.run_benchmarks --tickers 500 --years 20
+#   python -m benchmarks.run_benchmarks --save-baseline          # 將本次結果存為基準
+#   python -m benchmarks.run_benchmarks --baseline benchmarks/baseline.json --tolerance 0.2
+
+import argparse
+import json
+import os
+import platform
+import statistics
+import sys
+import time
+from datetime import datetime, timezone
+
+import numpy as np
+import pandas as pd
+
+from api.index import app
+from api.routes import backtest_route, scan_route
+from api.utils import data_handler, http_cache
+from api.utils.calculations import calculate_metrics
+from api.utils.simulation import get_rebalancing_dates, run_simulation
+
+BENCHMARK_TICKER = 'SPY'
+END_DATE = '2024-12-31'
+SECTORS = ['Technology', 'Healthcare', 'Financial Services', 'Energy', 'Industrials', 'Consumer Cyclical']
+DEFAULT_BASELINE_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'baseline.json')
+DEFAULT_OUTPUT_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'results', 'latest.json')
+
+
+# --- 合成數據 ---
+def generate_universe(n_tickers, n_years, seed=42):
+    """
+    產生 n_tickers 支股票 (外加基準 SPY) 的幾何布朗運動價格。
+    約兩成的股票上市日晚於起始日，以模擬真實數據中的缺值。
+    """
+    rng = np.random.default_rng(seed)
+    dates = pd.bdate_range(end=END_DATE, periods=int(n_years * 252))
+    tickers = [f'T{i:04d}' for i in range(n_tickers)] + [BENCHMARK_TICKER]
+
+    drifts = rng.normal(0.0003, 0.0002, len(tickers))
+    vols = rng.uniform(0.008, 0.03, len(tickers))
+    log_returns = rng.standard_normal((len(dates), len(tickers))) * vols + drifts
+    prices = 100 * np.exp(np.cumsum(log_returns, axis=0))
+
+    late_listed = rng.random(n_tickers) < 0.2
+    listing_offsets = rng.integers(0, len(dates) // 2, n_tickers)
+    for column, offset in zip(np.flatnonzero(late_listed), listing_offsets[late_listed]):
+        prices[:offset, column] = np.nan
+
+    return pd.DataFrame(prices, index=dates, columns=tickers)
+
+
+def generate_preprocessed_data(universe, seed=42):
+    """產生與 preprocessed_data.json 相同結構的基本面資料。"""
+    rng = np.random.default_rng(seed)
+    records = []
+    for ticker in universe.columns:
+        records.append({
+            'ticker': ticker, 'marketCap': float(rng.uniform(1e9, 2e12)), 'sector': SECTORS[rng.integers(len(SECTORS))],
+            'trailingPE': float(rng.uniform(5, 80)), 'forwardPE': float(rng.uniform(5, 60)),
+            'dividendYield': float(rng.uniform(0, 0.05)), 'returnOnEquity': float(rng.uniform(-0.2, 0.6)),
+            'revenueGrowth': float(rng.uniform(-0.3, 0.8)), 'earningsGrowth': float(rng.uniform(-0.5, 1.0)),
+            'in_sp500': bool(rng.random() < 0.8), 'in_nasdaq100': bool(rng.random() < 0.2),
+        })
+    return records
+
+
+def install_stubs(universe, records, latency_ms=0.0):
+    """
+    以合成數據取代遠端讀取函式。
+    替身仍經過 data_handler 的快取包裝，因此清除快取即可模擬冷啟動。
+    """
+    ticker_histories = {ticker: universe[[ticker]].dropna() for ticker in universe.columns}
+
+    def load_ticker_history_stub(ticker):
+        if latency_ms:
+            time.sleep(latency_ms / 1000)
+        return ticker_histories.get(ticker)
+
+    def get_preprocessed_data_stub():
+        if latency_ms:
+            time.sleep(latency_ms / 1000)
+        return records
+
+    # 清掉 preload 暖機時可能留下的遠端數據快取
+    data_handler.cache.clear()
+    data_handler.price_cache.clear()
+    data_handler.load_ticker_history = data_handler.instrumented_cached('ticker_prices', data_handler.price_cache)(load_ticker_history_stub)
+    get_preprocessed_data = data_handler.instrumented_cached('preprocessed')(get_preprocessed_data_stub)
+    for module in (data_handler, backtest_route, scan_route):
+        if hasattr(module, 'get_preprocessed_data'):
+            module.get_preprocessed_data = get_preprocessed_data
+    # ETag 的數據版本固定為常數，避免讀取遠端的 version.json
+    data_handler.get_data_version = http_cache.get_data_version = lambda: 'benchmark'
+
+
+# --- 計時 ---
+def time_case(func, repeat, cold):
+    """執行 func repeat 次並回傳耗時統計 (秒)。cold=True 時每次執行前清空數據快取。"""
+    durations = []
+    for _ in range(repeat):
+        if cold:
+            data_handler.cache.clear()
+            data_handler.price_cache.clear()
+        start_time = time.perf_counter()
+        func()
+        durations.append(time.perf_counter() - start_time)
+    return {'min': min(durations), 'median': statistics.median(durations), 'mean': statistics.mean(durations), 'runs': repeat}
+
+
+def build_cases(universe, n_years):
+    """建立所有基準測試案例：名稱 -> (函式, 是否為冷快取)。"""
+    client = app.test_client()
+    end_year = int(END_DATE[:4])
+    start_year = end_year - n_years + 1
+    stock_tickers = [ticker for ticker in universe.columns if ticker != BENCHMARK_TICKER]
+
+    common_prices = universe[stock_tickers[:3] + [BENCHMARK_TICKER]].dropna()
+    portfolio_config = {'name': 'bench', 'tickers': stock_tickers[:3], 'weights': [40, 30, 30], 'rebalancingPeriod': 'quarterly'}
+    benchmark_history = common_prices[[BENCHMARK_TICKER]].rename(columns={BENCHMARK_TICKER: 'value'})
+    stock_history = common_prices[[stock_tickers[0]]].rename(columns={stock_tickers[0]: 'value'})
+
+    scan_payload = {
+        'tickers': stock_tickers, 'benchmark': BENCHMARK_TICKER,
+        'startYear': start_year, 'startMonth': 1, 'endYear': end_year, 'endMonth': 12,
+    }
+    screener_payload = {
+        'index': 'sp500', 'sector': 'any',
+        'filters': {'trailingPE': {'min': 10, 'max': 40}, 'marketCap': {'min': 1e10}},
+    }
+    backtest_payload = {
+        'initialAmount': 10000, 'benchmark': BENCHMARK_TICKER,
+        'startYear': start_year, 'startMonth': 1, 'endYear': end_year, 'endMonth': 12,
+        'portfolios': [portfolio_config, {**portfolio_config, 'name': 'bench-annual', 'rebalancingPeriod': 'annually'}],
+    }
+    monte_carlo_payload = {**backtest_payload, 'numPaths': 2000, 'horizonYears': 20, 'seed': 42}
+    walk_forward_payload = {**backtest_payload, 'stepMonths': 6}
+
+    def post(url, payload):
+        def run():
+            response = client.post(url, json=payload)
+            if response.status_code != 200:
+                raise RuntimeError(f'{url} 回傳 {response.status_code}: {response.get_data(as_text=True)[:200]}')
+        return run
+
+    cases = {
+        'run_simulation': (lambda: run_simulation(portfolio_config, common_prices, 10000, benchmark_history), False),
+        'calculate_metrics': (lambda: calculate_metrics(stock_history, benchmark_history), False),
+        'get_rebalancing_dates': (lambda: get_rebalancing_dates(common_prices, 'monthly'), False),
+    }
+    for name, url, payload in (('backtest', '/api/backtest', backtest_payload),
+                               ('scan', '/api/scan', scan_payload),
+                               ('screener', '/api/screener', screener_payload),
+                               ('monte_carlo', '/api/monte-carlo', monte_carlo_payload),
+                               ('walk_forward', '/api/walk-forward', walk_forward_payload)):
+        cases[f'{name}_handler:cold'] = (post(url, payload), True)
+        cases[f'{name}_handler:warm'] = (post(url, payload), False)
+    return cases
+
+
+# --- 與基準比較 ---
+def compare_with_baseline(results, baseline, tolerance):
+    """回傳中位數耗時超過基準 (1 + tolerance) 倍的案例列表。"""
+    regressions = []
+    print(f"\n{'案例':<28}{'基準 (ms)':>12}{'本次 (ms)':>12}{'變化':>10}")
+    for name, stats in results.items():
+        baseline_stats = baseline.get('results', {}).get(name)
+        if baseline_stats is None:
+            print(f"{name:<28}{'-':>12}{stats['median'] * 1000:>12.2f}{'新增':>10}")
+            continue
+        change = stats['median'] / baseline_stats['median'] - 1
+        print(f"{name:<28}{baseline_stats['median'] * 1000:>12.2f}{stats['median'] * 1000:>12.2f}{change:>+10.1%}")
+        if change > tolerance:
+            regressions.append({'case': name, 'baseline': baseline_stats['median'], 'current': stats['median'], 'change': change})
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='回測 API 熱路徑的離線效能基準測試')
+    parser.add_argument('--tickers', type=int, default=500, help='合成宇宙的股票數量')
+    parser.add_argument('--years', type=int, default=20, help='合成價格的年數')
+    parser.add_argument('--repeat', type=int, default=5, help='每個案例的重複次數')
+    parser.add_argument('--seed', type=int, default=42)
+    parser.add_argument('--latency-ms', type=float, default=0.0, help='模擬每次遠端讀取的延遲')
+    parser.add_argument('--only', nargs='*', help='只執行名稱包含這些字串的案例')
+    parser.add_argument('--output', default=DEFAULT_OUTPUT_PATH, help='結果 JSON 的輸出路徑')
+    parser.add_argument('--baseline', default=DEFAULT_BASELINE_PATH, help='用來比較的基準 JSON')
+    parser.add_argument('--save-baseline', action='store_true', help='將本次結果寫入 --baseline 路徑')
+    parser.add_argument('--tolerance', type=float, default=0.2, help='允許的中位數退化比例')
+    args = parser.parse_args(argv)
+
+    universe = generate_universe(args.tickers, args.years, args.seed)
+    install_stubs(universe, generate_preprocessed_data(universe, args.seed), args.latency_ms)
+
+    results = {}
+    for name, (func, cold) in build_cases(universe, args.years).items():
+        if args.only and not any(pattern in name for pattern in args.only):
+            continue
+        results[name] = time_case(func, args.repeat, cold)
+        print(f"{name:<28} median={results[name]['median'] * 1000:9.2f} ms  min={results[name]['min'] * 1000:9.2f} ms")
+
+    report = {
+        'meta': {
+            'tickers': args.tickers, 'years': args.years, 'repeat': args.repeat, 'seed': args.seed,
+            'latency_ms': args.latency_ms, 'python': platform.python_version(), 'platform': platform.platform(),
+            'pandas': pd.__version__, 'numpy': np.__version__, 'timestamp': datetime.now(timezone.utc).isoformat(),
+        },
+        'results': results,
+    }
+    os.makedirs(os.path.dirname(os.path.abspath(args.output)), exist_ok=True)
+    with open(args.output, 'w', encoding='utf-8') as f:
+        json.dump(report, f, ensure_ascii=False, indent=2)
+    print(f"\n結果已寫入 {args.output}")
+
+    if args.save_baseline:
+        with open(args.baseline, 'w', encoding='utf-8') as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+        print(f"基準已寫入 {args.baseline}")
+        return 0
+
+    if not os.path.exists(args.baseline):
+        print(f"找不到基準檔 {args.baseline}，略過比較 (可使用 --save-baseline 建立)。")
+        return 0
+
+    with open(args.baseline, encoding='utf-8') as f:
+        baseline = json.load(f)
+    if (baseline['meta']['tickers'], baseline['meta']['years']) != (args.tickers, args.years):
+        print("警告：基準的宇宙大小與本次不同，比較結果僅供參考。")
+    regressions = compare_with_baseline(results, baseline, args.tolerance)
+    if regressions:
+        print(f"\n偵測到 {len(regressions)} 個效能退化 (容忍度 {args.tolerance:.0%})：")
+        for item in regressions:
+            print(f"  {item['case']}: {item['baseline'] * 1000:.2f} ms -> {item['current'] * 1000:.2f} ms ({item['change']:+.1%})")
+        return 1
+    print("\n沒有偵測到效能退化。")
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -2,10 +2,35 @@
 import { dom } from './dom.js';
 import { displayError } from '../backtester/backtester_ui.js';
 
-async function fetchApi(url, options) {
+// POST 回應不會進入瀏覽器的 HTTP 快取，因此自行保存 ETag 與結果，
+// 重複的請求帶上 If-None-Match，伺服器回傳 304 時直接沿用保存的結果。
+const ETAG_STORAGE_PREFIX = 'api-etag:';
+const memoryCache = new Map();
+
+function readCachedResponse(key) {
+    if (memoryCache.has(key)) return memoryCache.get(key);
+    try {
+        const stored = sessionStorage.getItem(ETAG_STORAGE_PREFIX + key);
+        return stored ? JSON.parse(stored) : null;
+    } catch (error) { return null; }
+}
+function writeCachedResponse(key, entry) {
+    memoryCache.set(key, entry);
+    // 結果過大超出 sessionStorage 配額時，只保留在記憶體中
+    try { sessionStorage.setItem(ETAG_STORAGE_PREFIX + key, JSON.stringify(entry)); } catch (error) { /* 忽略 */ }
+}
+
+async function fetchApi(url, options = {}) {
+    const cacheKey = options.method === 'POST' ? `${url}|${options.body}` : null;
+    const cached = cacheKey ? readCachedResponse(cacheKey) : null;
+    if (cached) options = { ...options, headers: { ...options.headers, 'If-None-Match': cached.etag } };
+
     const response = await fetch(url, options);
+    if (response.status === 304 && cached) return cached.result;
     const result = await response.json();
     if (!response.ok) throw new Error(result.error || `HTTP 錯誤: ${response.status}`);
+    const etag = response.headers.get('ETag');
+    if (cacheKey && etag) writeCachedResponse(cacheKey, { etag, result });
     return result;
 }
 export async function fetchAvailableTickers() {
@@ -0,0 +1,67 @@
+import unittest
+
+import numpy as np
+import pandas as pd
+
+from api.utils.accumulators import STANDARD_WINDOWS, update_metric_states, window_metrics
+
+
+def make_prices(seed, dates):
+    rng = np.random.default_rng(seed)
+    return pd.Series(100 * np.exp(np.cumsum(rng.normal(0.0003, 0.015, len(dates)))), index=dates)
+
+
+class UpdateMetricStatesTest(unittest.TestCase):
+    def setUp(self):
+        dates = pd.bdate_range('2019-06-03', '2021-03-31')
+        # AAA 缺少部分交易日，讓 Beta 只在與基準配對的日期上累積
+        self.prices = {
+            'SPY': make_prices(1, dates),
+            'AAA': make_prices(2, dates).drop(dates[[40, 41, 300]]),
+        }
+        self.end_dates = dates[-60:]
+
+    def loader(self, end_date, failing=()):
+        def load_prices(ticker):
+            if ticker in failing:
+                return None
+            return self.prices[ticker].loc[:end_date]
+        return load_prices
+
+    def assertStatesEqual(self, state, expected):
+        self.assertEqual(set(state['tickers']), set(expected['tickers']))
+        for ticker, ticker_state in expected['tickers'].items():
+            self.assertEqual(state['tickers'][ticker]['lastDate'], ticker_state['lastDate'])
+            for name in STANDARD_WINDOWS:
+                window, expected_window = state['tickers'][ticker]['windows'][name], ticker_state['windows'][name]
+                self.assertEqual(window['count'], expected_window['count'])
+                self.assertEqual(window['benchmark']['count'], expected_window['benchmark']['count'])
+                metrics, expected_metrics = window_metrics(window), window_metrics(expected_window)
+                for metric, value in expected_metrics.items():
+                    self.assertAlmostEqual(metrics[metric], value, places=9, msg=f'{ticker} {name} {metric}')
+
+    def test_bar_by_bar_updates_match_full_rebuild(self):
+        state, _ = update_metric_states(None, self.loader(self.end_dates[0]), ['AAA'])
+        for end_date in self.end_dates[1:]:
+            state, summary = update_metric_states(state, self.loader(end_date), ['AAA'])
+            self.assertEqual(summary['rebuilt'], 0)
+
+        rebuilt, _ = update_metric_states(None, self.loader(self.end_dates[-1]), ['AAA'])
+        self.assertStatesEqual(state, rebuilt)
+
+    def test_benchmark_outage_keeps_states_until_benchmark_returns(self):
+        state, _ = update_metric_states(None, self.loader(self.end_dates[0]), ['AAA'])
+        for end_date in self.end_dates[1:11]:
+            previous = state
+            state, summary = update_metric_states(state, self.loader(end_date, failing=('SPY',)), ['AAA'])
+            self.assertEqual(summary['failed'], 2)
+            self.assertEqual(state['tickers'], previous['tickers'])
+
+        state, summary = update_metric_states(state, self.loader(self.end_dates[11]), ['AAA'])
+        self.assertEqual(summary['incremental'], 2)
+        rebuilt, _ = update_metric_states(None, self.loader(self.end_dates[11]), ['AAA'])
+        self.assertStatesEqual(state, rebuilt)
+
+
+if __name__ == '__main__':
+    unittest.main()
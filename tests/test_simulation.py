@@ -0,0 +1,53 @@
+import unittest
+
+import numpy as np
+import pandas as pd
+
+from api.utils.calculations import EPSILON
+from api.utils.simulation import get_rebalancing_dates, run_simulation
+
+
+def per_day_history(portfolio_config, df_prices, initial_amount):
+    """改寫為向量化之前 run_simulation 逐日更新持股的迴圈，作為 simulate_values 的對照。"""
+    weights = np.array(portfolio_config['weights']) / 100.0
+    df_prices = df_prices[portfolio_config['tickers']]
+    portfolio_history = pd.Series(index=df_prices.index, dtype=float, name="value")
+    rebalancing_dates = get_rebalancing_dates(df_prices, portfolio_config['rebalancingPeriod'])
+
+    current_date = df_prices.index[0]
+    shares = (initial_amount * weights) / (df_prices.loc[current_date] + EPSILON)
+    portfolio_history.loc[current_date] = initial_amount
+    for i in range(1, len(df_prices)):
+        current_date = df_prices.index[i]
+        current_prices = df_prices.loc[current_date]
+        current_value = (shares * current_prices).sum()
+        portfolio_history.loc[current_date] = current_value
+        if current_date in rebalancing_dates:
+            shares = (current_value * weights) / (current_prices + EPSILON)
+    return portfolio_history.dropna()
+
+
+class RunSimulationTest(unittest.TestCase):
+    def setUp(self):
+        rng = np.random.default_rng(7)
+        dates = pd.bdate_range('2018-01-01', '2021-12-31')
+        prices = 100 * np.exp(np.cumsum(rng.normal(0.0003, 0.015, (len(dates), 3)), axis=0))
+        self.prices = pd.DataFrame(prices, index=dates, columns=['AAA', 'BBB', 'CCC'])
+        # 缺值的價格不計入當日淨值
+        self.prices.iloc[100, 1] = np.nan
+
+    def test_matches_per_day_loop(self):
+        for period in ('never', 'annually', 'quarterly', 'monthly'):
+            for tickers, weights in ((['AAA'], [100]), (['AAA', 'BBB', 'CCC'], [50, 30, 20])):
+                config = {'name': period, 'tickers': tickers, 'weights': weights, 'rebalancingPeriod': period}
+                with self.subTest(period=period, tickers=tickers):
+                    result = run_simulation(config, self.prices, 10000.0)
+                    expected = per_day_history(config, self.prices, 10000.0)
+                    self.assertEqual([point['date'] for point in result['portfolioHistory']],
+                                     [date.strftime('%Y-%m-%d') for date in expected.index])
+                    np.testing.assert_allclose([point['value'] for point in result['portfolioHistory']],
+                                               expected.to_numpy(), rtol=1e-12)
+
+
+if __name__ == '__main__':
+    unittest.main()
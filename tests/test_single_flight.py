@@ -0,0 +1,158 @@
+import threading
+import time
+import unittest
+
+from api.utils.single_flight import SingleFlightCache
+
+
+class FakeTimer:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+class HungLoader:
+    """呼叫後一直阻塞，直到 release() 才回傳 value。"""
+
+    def __init__(self, value):
+        self.value = value
+        self.started = threading.Event()
+        self._release = threading.Event()
+
+    def __call__(self):
+        self.started.set()
+        self._release.wait(10)
+        return self.value
+
+    def release(self):
+        self._release.set()
+
+
+class CountingLoader:
+    """記錄被呼叫的次數；設定 gated 時阻塞到 release() 才回傳 (或拋出 error)。"""
+
+    def __init__(self, value=None, error=None, gated=False):
+        self.value = value
+        self.error = error
+        self.calls = 0
+        self.started = threading.Event()
+        self._release = threading.Event()
+        if not gated:
+            self._release.set()
+        self._lock = threading.Lock()
+
+    def __call__(self):
+        with self._lock:
+            self.calls += 1
+        self.started.set()
+        self._release.wait(10)
+        if self.error is not None:
+            raise self.error
+        return self.value
+
+    def release(self):
+        self._release.set()
+
+
+class SingleFlightCacheTest(unittest.TestCase):
+    def setUp(self):
+        self.timer = FakeTimer()
+        self.cache = SingleFlightCache(maxsize=8, ttl=10, stale_ttl=10, negative_ttl=5, wait_timeout=5, timer=self.timer)
+
+    def test_concurrent_misses_call_loader_once(self):
+        loader = CountingLoader('value', gated=True)
+        barrier = threading.Barrier(8)
+        results = []
+
+        def request():
+            barrier.wait()
+            results.append(self.cache.load('key', loader))
+
+        threads = [threading.Thread(target=request, daemon=True) for _ in range(8)]
+        for thread in threads:
+            thread.start()
+        self.assertTrue(loader.started.wait(1))
+        time.sleep(0.1)
+        loader.release()
+        for thread in threads:
+            thread.join(2)
+
+        self.assertEqual(loader.calls, 1)
+        self.assertEqual(len(results), 8)
+        self.assertTrue(all(value == 'value' for value, _ in results))
+        self.assertEqual([status for _, status in results].count('miss'), 1)
+
+    def test_stale_value_served_during_single_background_refresh(self):
+        self.cache.load('key', lambda: 'v1')
+        self.timer.now = 15
+        refresh = CountingLoader('v2', gated=True)
+        for _ in range(5):
+            self.assertEqual(self.cache.peek('key', refresh), (True, 'v1', 'stale'))
+        self.assertTrue(refresh.started.wait(1))
+
+        refresh.release()
+        for _ in range(100):
+            if self.cache.peek('key', refresh)[1] == 'v2':
+                break
+            time.sleep(0.01)
+        self.assertEqual(refresh.calls, 1)
+        self.assertEqual(self.cache.load('key', lambda: 'unused'), ('v2', 'hit'))
+
+    def test_negative_cache_expires_after_ttl(self):
+        failing = CountingLoader(error=ValueError('remote failed'))
+        with self.assertRaises(ValueError):
+            self.cache.load('key', failing)
+
+        # negative_ttl 期間內直接拋出快取的例外，不再呼叫 loader
+        self.timer.now = 4.9
+        with self.assertRaises(ValueError):
+            self.cache.load('key', failing)
+        self.assertEqual(failing.calls, 1)
+
+        self.timer.now = 5
+        succeeding = CountingLoader('value')
+        self.assertEqual(self.cache.load('key', succeeding), ('value', 'miss'))
+        self.assertEqual((failing.calls, succeeding.calls), (1, 1))
+
+
+class SingleFlightCacheHungLoadTest(unittest.TestCase):
+    def setUp(self):
+        self.timer = FakeTimer()
+        self.cache = SingleFlightCache(maxsize=8, ttl=10, stale_ttl=10, negative_ttl=5, wait_timeout=0.2, timer=self.timer)
+
+    def test_hung_stale_refresh_does_not_block_later_loads(self):
+        self.assertEqual(self.cache.load('key', lambda: 'v1'), ('v1', 'miss'))
+
+        # 過期但仍在 stale 期間：回傳舊值，並在背景以卡住的 loader 更新
+        self.timer.now = 15
+        hung = HungLoader('stale-refresh')
+        self.assertEqual(self.cache.peek('key', hung), (True, 'v1', 'stale'))
+        self.assertTrue(hung.started.wait(1))
+
+        # stale 期間結束後，卡住的背景更新已逾時，新的請求重新載入而不是永久等待
+        self.timer.now = 25
+        self.assertEqual(self.cache.load('key', lambda: 'v2'), ('v2', 'miss'))
+
+        # 卡住的載入最後完成時，不會以舊結果覆蓋新的值
+        hung.release()
+        time.sleep(0.05)
+        self.assertEqual(self.cache.load('key', lambda: 'v3'), ('v2', 'hit'))
+
+    def test_waiting_on_hung_load_times_out(self):
+        hung = HungLoader('slow')
+        leader = threading.Thread(target=self.cache.load, args=('key', hung), daemon=True)
+        leader.start()
+        self.assertTrue(hung.started.wait(1))
+
+        start_time = time.monotonic()
+        with self.assertRaises(TimeoutError):
+            self.cache.load('key', lambda: 'unused')
+        self.assertLess(time.monotonic() - start_time, 2)
+        hung.release()
+        leader.join(1)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,10 +1,13 @@
 import pandas as pd
 import yfinance as yf
 import json
+import os
 import time
+import requests
 from pathlib import Path
 from concurrent.futures import ThreadPoolExecutor, as_completed
 from tqdm import tqdm
+from api.utils.accumulators import METRIC_BENCHMARK, update_metric_states
 
 # --- 設定資料儲存路徑 ---
 data_folder = Path("data")
@@ -12,6 +15,12 @@ prices_folder = data_folder / "prices"
 data_folder.mkdir(exist_ok=True)
 prices_folder.mkdir(exist_ok=True)
 PREPROCESSED_JSON_PATH = data_folder / "preprocessed_data.json"
+METRIC_STATE_PATH = data_folder / "metric_state.json"
+# 數據快照的版本，API 以此產生 HTTP ETag；每次更新完成後寫入
+VERSION_JSON_PATH = data_folder / "version.json"
+# 上一次的指標狀態存放在 data 分支；工作流程每次都從乾淨的 checkout 開始，本地沒有檔案時改從遠端讀取
+GITHUB_REPOSITORY = os.environ.get('GITHUB_REPOSITORY', 'chihung1024/Backtest')
+METRIC_STATE_URL = f"https://raw.githubusercontent.com/{GITHUB_REPOSITORY}/data/metric_state.json"
 
 # --- 平行下載設定 ---
 # 同時開啟的下載執行緒數量，可根據需求調整
@@ -63,19 +72,71 @@ def fetch_stock_info(ticker):
         # print(f"  -> 無法獲取 {ticker} 的基本面數據: {e}")
         return None
 
+def build_price_frame(history):
+    """
+    由 auto_adjust=False 的歷史資料 (含 Dividends / Stock Splits) 建立要儲存的價格表。
+    Close      : 還原股息的收盤價 (總報酬)，與舊版 auto_adjust=True 的 Close 相同，舊的讀取端不受影響
+    PriceFactor: 累積調整因子，Close * PriceFactor 即為只含價格變動 (不含股息) 的收盤價
+    SplitFactor: 累積分割因子，Close * PriceFactor * SplitFactor 即為未經分割調整的原始收盤價
+    Dividends  : 每股現金股息 (除息日)
+    """
+    split_close = history['Close']  # yfinance 的 Close 已做分割調整，但未還原股息
+    adj_close = history['Adj Close']
+    split_ratios = history['Stock Splits'].replace(0, 1.0)
+    # 某日的原始價格 = 分割調整後價格 x 該日之後所有分割比例的乘積
+    split_factor = split_ratios[::-1].cumprod()[::-1].shift(-1, fill_value=1.0)
+    price_df = pd.DataFrame({
+        'Close': adj_close,
+        'PriceFactor': split_close / adj_close,
+        'SplitFactor': split_factor,
+        'Dividends': history['Dividends'],
+    })
+    price_df.index = price_df.index.tz_localize(None).normalize()
+    price_df.index.name = 'Date'
+    return price_df.dropna(subset=['Close'])
+
 def fetch_price_history(ticker):
-    """下載單支股票的歷史價格並儲存為 CSV"""
+    """下載單支股票的歷史價格 (含股息與分割資訊) 並儲存為 CSV"""
     try:
-        data = yf.download(ticker, start="1990-01-01", auto_adjust=True, progress=False)
-        if not data.empty:
-            price_df = data[['Close']].copy()
-            price_df.to_csv(prices_folder / f"{ticker}.csv")
+        history = yf.Ticker(ticker).history(start="1990-01-01", auto_adjust=False, actions=True)
+        if not history.empty:
+            price_df = build_price_frame(history)
+            # 以 10 位有效數字儲存，維持 CSV 精簡
+            price_df.to_csv(prices_folder / f"{ticker}.csv", float_format='%.10g')
             return ticker, True # 回傳成功標記
         return ticker, False # 回傳失敗標記
     except Exception as e:
         # print(f"  -> 下載 {ticker} 價格時發生錯誤: {e}")
         return ticker, False
 
+# --- 增量指標狀態 ---
+def load_previous_metric_state():
+    """讀取上一次的指標狀態，找不到時回傳 None (將從完整歷史重建)。"""
+    if METRIC_STATE_PATH.exists():
+        with open(METRIC_STATE_PATH, encoding='utf-8') as f:
+            return json.load(f)
+    try:
+        response = requests.get(METRIC_STATE_URL, timeout=60)
+        response.raise_for_status()
+        return response.json()
+    except Exception as e:
+        print(f"  -> 無法讀取上一次的指標狀態，將從完整歷史重建: {e}")
+        return None
+
+def load_saved_prices(ticker):
+    """讀取剛下載的價格檔中的收盤價 (總報酬)。"""
+    try:
+        return pd.read_csv(prices_folder / f"{ticker}.csv", index_col='Date', parse_dates=True)['Close']
+    except Exception:
+        return None
+
+def update_metric_state(tickers):
+    """只將每支股票新增的 K 棒併入各標準區間的累加值，並寫回 metric_state.json。"""
+    state, summary = update_metric_states(load_previous_metric_state(), load_saved_prices, tickers)
+    with open(METRIC_STATE_PATH, 'w', encoding='utf-8') as f:
+        json.dump(state, f, separators=(',', ':'))
+    print(f"指標狀態更新完成：增量 {summary['incremental']} 支、重建 {summary['rebuilt']} 支、失敗 {summary['failed']} 支，共併入 {summary['bars']} 根 K 棒。")
+
 # --- 主執行函式 (已重構為平行處理) ---
 def main():
     """主執行函式"""
@@ -93,7 +154,7 @@ def main():
     print(f"總共找到 {len(all_unique_tickers)} 支不重複的股票。")
 
     # --- 平行處理基本面數據 ---
-    print("\n--- 步驟 1/2: 平行下載基本面數據 ---")
+    print("\n--- 步驟 1/3: 平行下載基本面數據 ---")
     all_stock_data = []
     with ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor:
         # 將下載任務提交到執行緒池
@@ -112,16 +173,24 @@ def main():
     print(f"基本面數據處理完成，共獲取 {len(all_stock_data)} 筆有效資料。")
 
     # --- 平行處理歷史價格 ---
-    print("\n--- 步驟 2/2: 平行下載歷史價格數據 ---")
+    print("\n--- 步驟 2/3: 平行下載歷史價格數據 ---")
+    # 指標狀態的 Beta/Alpha 以 METRIC_BENCHMARK 為基準，一併下載其價格
+    price_tickers = sorted(set(all_unique_tickers) | {METRIC_BENCHMARK})
     success_count = 0
     with ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor:
-        future_to_ticker = {executor.submit(fetch_price_history, ticker): ticker for ticker in all_unique_tickers}
-        for future in tqdm(as_completed(future_to_ticker), total=len(all_unique_tickers), desc="下載價格"):
+        future_to_ticker = {executor.submit(fetch_price_history, ticker): ticker for ticker in price_tickers}
+        for future in tqdm(as_completed(future_to_ticker), total=len(price_tickers), desc="下載價格"):
             _ticker, success = future.result()
             if success:
                 success_count += 1
     
     print(f"歷史價格數據更新完成，共成功下載 {success_count} 支股票。")
 
+    print("\n--- 步驟 3/3: 增量更新指標狀態 ---")
+    update_metric_state(all_unique_tickers)
+
+    with open(VERSION_JSON_PATH, 'w', encoding='utf-8') as f:
+        json.dump({'version': time.strftime('%Y%m%dT%H%M%SZ', time.gmtime())}, f)
+
 if __name__ == '__main__':
     main()
@@ -5,11 +5,14 @@
 import pandas as pd
 import yfinance as yf
 import json
+import io
 import os
+import time
 import boto3
 from concurrent.futures import ThreadPoolExecutor, as_completed
 from tqdm import tqdm
 from botocore.exceptions import ClientError
+from api.utils.accumulators import METRIC_BENCHMARK, update_metric_states
 
 # --- 設定 ---
 # 從環境變數讀取 R2 連線資訊
@@ -55,6 +58,15 @@ def upload_to_r2(s3_client, key, body, content_type='text/plain'):
         print(f"  -> 上傳 {key} 到 R2 失敗: {e}")
         return False
 
+def download_json_from_r2(s3_client, key):
+    """從 R2 讀取一個 JSON 物件，不存在或讀取失敗時回傳 None"""
+    try:
+        response = s3_client.get_object(Bucket=R2_BUCKET_NAME, Key=key)
+        return json.loads(response['Body'].read())
+    except Exception as e:
+        print(f"  -> 無法從 R2 讀取 {key}: {e}")
+        return None
+
 # --- 數據獲取函式 (與原版相同) ---
 def get_etf_holdings(etf_ticker):
     try:
@@ -98,13 +110,37 @@ def fetch_stock_info(ticker):
     except Exception:
         return None
 
+def build_price_frame(history):
+    """
+    由 auto_adjust=False 的歷史資料 (含 Dividends / Stock Splits) 建立要儲存的價格表。
+    Close      : 還原股息的收盤價 (總報酬)，與舊版 auto_adjust=True 的 Close 相同，舊的讀取端不受影響
+    PriceFactor: 累積調整因子，Close * PriceFactor 即為只含價格變動 (不含股息) 的收盤價
+    SplitFactor: 累積分割因子，Close * PriceFactor * SplitFactor 即為未經分割調整的原始收盤價
+    Dividends  : 每股現金股息 (除息日)
+    """
+    split_close = history['Close']  # yfinance 的 Close 已做分割調整，但未還原股息
+    adj_close = history['Adj Close']
+    split_ratios = history['Stock Splits'].replace(0, 1.0)
+    # 某日的原始價格 = 分割調整後價格 x 該日之後所有分割比例的乘積
+    split_factor = split_ratios[::-1].cumprod()[::-1].shift(-1, fill_value=1.0)
+    price_df = pd.DataFrame({
+        'Close': adj_close,
+        'PriceFactor': split_close / adj_close,
+        'SplitFactor': split_factor,
+        'Dividends': history['Dividends'],
+    })
+    price_df.index = price_df.index.tz_localize(None).normalize()
+    price_df.index.name = 'Date'
+    return price_df.dropna(subset=['Close'])
+
 def fetch_price_history(ticker):
-    """下載單支股票的歷史價格，並返回 CSV 字串"""
+    """下載單支股票的歷史價格 (含股息與分割資訊)，並返回 CSV 字串"""
     try:
-        data = yf.download(ticker, start="1990-01-01", auto_adjust=True, progress=False)
-        if not data.empty:
-            price_df = data[['Close']].copy()
-            return ticker, price_df.to_csv()
+        history = yf.Ticker(ticker).history(start="1990-01-01", auto_adjust=False, actions=True)
+        if not history.empty:
+            price_df = build_price_frame(history)
+            # 以 10 位有效數字儲存，維持 CSV 精簡
+            return ticker, price_df.to_csv(float_format='%.10g')
         return ticker, None
     except Exception:
         return ticker, None
@@ -135,7 +171,7 @@ def main():
     print(f"總共找到 {len(all_unique_tickers)} 支不重複的股票。")
 
     # --- 平行處理基本面數據 ---
-    print("\n--- 步驟 1/2: 平行下載基本面數據 ---")
+    print("\n--- 步驟 1/3: 平行下載基本面數據 ---")
     all_stock_data = []
     with ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor:
         future_to_ticker = {executor.submit(fetch_stock_info, ticker): ticker for ticker in all_unique_tickers}
@@ -152,17 +188,31 @@ def main():
         print(f"基本面數據處理完成，共 {len(all_stock_data)} 筆有效資料已上傳至 R2。")
 
     # --- 平行處理歷史價格 ---
-    print("\n--- 步驟 2/2: 平行下載歷史價格數據並上傳 ---")
+    print("\n--- 步驟 2/3: 平行下載歷史價格數據並上傳 ---")
+    # 指標狀態的 Beta/Alpha 以 METRIC_BENCHMARK 為基準，一併下載其價格
+    price_tickers = sorted(set(all_unique_tickers) | {METRIC_BENCHMARK})
+    # 只保留收盤價供步驟 3 使用，不保存整份 CSV 字串
+    close_prices = {}
     success_count = 0
     with ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor:
-        future_to_csv = {executor.submit(fetch_price_history, ticker): ticker for ticker in all_unique_tickers}
-        for future in tqdm(as_completed(future_to_csv), total=len(all_unique_tickers), desc="下載並上傳價格"):
+        future_to_csv = {executor.submit(fetch_price_history, ticker): ticker for ticker in price_tickers}
+        for future in tqdm(as_completed(future_to_csv), total=len(price_tickers), desc="下載並上傳價格"):
             ticker, csv_content = future.result()
             if csv_content:
+                close_prices[ticker] = pd.read_csv(io.StringIO(csv_content), index_col='Date', parse_dates=True)['Close']
                 if upload_to_r2(s3_client, f"prices/{ticker}.csv", csv_content, 'text/csv'):
                     success_count += 1
     
     print(f"歷史價格數據更新完成，共成功下載並上傳 {success_count} 支股票。")
 
+    # --- 增量更新指標狀態 ---
+    print("\n--- 步驟 3/3: 增量更新指標狀態並上傳 ---")
+    state, summary = update_metric_states(download_json_from_r2(s3_client, 'metric_state.json'), close_prices.get, all_unique_tickers)
+    if upload_to_r2(s3_client, 'metric_state.json', json.dumps(state, separators=(',', ':')), 'application/json'):
+        print(f"指標狀態更新完成：增量 {summary['incremental']} 支、重建 {summary['rebuilt']} 支、失敗 {summary['failed']} 支，共併入 {summary['bars']} 根 K 棒。")
+
+    # 數據快照的版本，API 以此產生 HTTP ETag
+    upload_to_r2(s3_client, 'version.json', json.dumps({'version': time.strftime('%Y%m%dT%H%M%SZ', time.gmtime())}), 'application/json')
+
 if __name__ == '__main__':
     main()